@@ -0,0 +1,103 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Measures how long cache population takes at boot.
+#
+# Run this from the website directory so config.yml can be found:
+#     python3 benchmarks/boot.py [files] [urls] [users]
+#
+# The rows are seeded into a throwaway imago_benchmark schema on the configured
+# Postgres server, which is dropped again once the benchmark has finished.
+
+# =====================
+# Import PATH libraries
+# =====================
+# -----------------
+# Builtin libraries
+# -----------------
+import os.path
+import sys
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from psycopg2 import connect
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console, loader
+from util.constants import config, const
+from util.registry import Registry
+
+
+SCHEMA = "imago_benchmark"
+
+
+def seed(connection,
+         files: int,
+         urls: int,
+         users: int):
+    """Creates the benchmark schema and fills it with generated rows."""
+
+    with connection.cursor() as con:
+        con.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        con.execute(f"CREATE SCHEMA {SCHEMA};")
+        con.execute(f"SET search_path TO {SCHEMA};")
+
+        con.execute("""CREATE TABLE users (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, admin BOOLEAN, token TEXT, created_at TIMESTAMP);""")
+        con.execute("""CREATE TABLE files (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, deleted BOOLEAN, created_at TIMESTAMP, digest TEXT, size BIGINT, mimetype TEXT, width INT, height INT);""")
+        con.execute("""CREATE TABLE urls (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, url TEXT, created_at TIMESTAMP);""")
+
+        con.execute("""INSERT INTO users (username, password, admin, token, created_at)
+                       SELECT 'user' || i, 'password', false, md5(i::text), now()
+                       FROM generate_series(1, %(users)s) AS i;""",
+                    dict(users=users))
+
+        con.execute("""INSERT INTO files (owner_id, key, deleted, created_at)
+                       SELECT 1 + i %% %(users)s, substr(md5(i::text), 1, 12) || '.png', false, now() - i * interval '1 second'
+                       FROM generate_series(1, %(files)s) AS i;""",
+                    dict(users=users,
+                         files=files))
+
+        con.execute("""INSERT INTO urls (owner_id, key, url, created_at)
+                       SELECT 1 + i %% %(users)s, substr(md5(i::text), 1, 6), 'https://example.com/' || i, now() - i * interval '1 second'
+                       FROM generate_series(1, %(urls)s) AS i;""",
+                    dict(users=users,
+                         urls=urls))
+
+        con.execute("""CREATE INDEX files_created_at ON files (created_at);""")
+        con.execute("""CREATE INDEX urls_created_at ON urls (created_at);""")
+        con.execute("""ANALYZE;""")
+
+    connection.commit()
+
+
+if __name__ == "__main__":
+    files, urls, users = (list(map(int, sys.argv[1:4])) + [1000000, 100000, 100][len(sys.argv[1:4]):])
+
+    connection = connect(dsn="user={pg.user} password={pg.password} host={pg.host} port={pg.port} dbname={pg.database}".format(pg=config.postgres))
+
+    console.info(text=f"Seeding {files} files, {urls} URLs and {users} users...")
+    seed(connection=connection,
+         files=files,
+         urls=urls,
+         users=users)
+
+    try:
+        started = perf_counter()
+        loader.populate(connection=connection,
+                        registry=Registry(superuser=const.superuser))
+        elapsed = perf_counter() - started
+
+        print(f"Populated {files + urls + users} rows in {round(elapsed, 2)}s ({round((files + urls + users) / elapsed)} rows/s).")
+
+    finally:
+        with connection.cursor() as con:
+            con.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+
+        connection.commit()
+        connection.close()
@@ -0,0 +1,108 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Checks that the s3 storage backend round-trips objects against a real store, and times it.
+#
+# Run this from the website directory so config.yml can be found:
+#     python3 benchmarks/storage.py [endpoint_url]
+#
+# The bucket and credentials are read from storage.s3 in config.yml, whichever backend
+# is chosen there, and endpoint_url overrides the configured one. For a local MinIO:
+#     docker run -p 9000:9000 minio/minio server /data
+#     python3 benchmarks/storage.py http://localhost:9000
+# Every object is written under a throwaway prefix and deleted again. It exits with
+# status 1 as soon as a check fails.
+
+# =====================
+# Import PATH libraries
+# =====================
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+import os.path
+import sys
+
+from io import BytesIO
+from time import perf_counter
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console
+from util.constants import config
+from util.storage import S3Storage
+
+
+def check(label: str,
+          passed: bool):
+    """Logs the outcome of a check, exiting if it failed."""
+
+    if not passed:
+        console.error(text=f"FAILED: {label}")
+        sys.exit(1)
+
+    console.info(text=f"ok: {label}")
+
+def round_trip(storage: S3Storage,
+               size: int):
+    """Stores an object of size random bytes, then reads, ranges, stats and deletes it."""
+
+    name = uuid4().hex
+    data = os.urandom(size)
+
+    started = perf_counter()
+    storage.put(name=name,
+                stream=BytesIO(data))
+    stored = perf_counter() - started
+
+    try:
+        started = perf_counter()
+        read = b"".join(storage.open(name=name))
+        fetched = perf_counter() - started
+
+        check(label=f"{size} bytes read back whole ({round(stored, 2)}s to put, {round(fetched, 2)}s to get)",
+              passed=read == data)
+
+        offset, length = size // 3, min(size // 3, 1000)
+        check(label=f"{length} bytes read back from offset {offset}",
+              passed=b"".join(storage.open(name=name, offset=offset, length=length)) == data[offset:offset + length])
+
+        found = storage.stat(name=name)
+        check(label=f"{size} bytes stat",
+              passed=found is not None and found.st_size == size)
+
+    finally:
+        storage.delete(name=name)
+
+    check(label=f"{size} bytes deleted",
+          passed=storage.stat(name=name) is None)
+
+
+if __name__ == "__main__":
+    s3 = config.storage.s3
+
+    storage = S3Storage(bucket=s3.bucket,
+                        prefix=f"{s3.prefix}imago-check-{uuid4().hex[:8]}/",
+                        endpoint_url=sys.argv[1] if len(sys.argv) > 1 else s3.endpoint_url,
+                        region=s3.region,
+                        access_key=s3.access_key,
+                        secret_key=s3.secret_key,
+                        part_size=s3.part_size_megabytes * 1024**2)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # one object small enough for a single PUT, and one that
+    # takes a multipart upload with a short last part
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    for size in (1024, storage.part_size * 2 + 1):
+        round_trip(storage=storage,
+                   size=size)
+
+    check(label="missing objects stat as None",
+          passed=storage.stat(name=uuid4().hex) is None)
+
+    storage.delete(name=uuid4().hex)
+    check(label="deleting a missing object is not an error",
+          passed=True)
@@ -114,7 +114,7 @@ def edit_user_page(victim_id: int):
         return redirect(location="/api/login",
                         code=303), 303
 
-    victim = utils.check_user(token=victim_id)
+    victim = utils.get_user(token_or_id=victim_id)
 
     if victim is None:
         return jsonify(dict(code=422,
@@ -4,27 +4,35 @@
 # ========================
 # Import PATH dependencies
 # ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Optional
+
 # -----------------
 # Builtin libraries
 # -----------------
 import os.path
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from mimetypes import guess_type
 from re import match
 from os import remove, rename, replace
 
 # ------------------------
 # Third-party dependencies
 # ------------------------
-from flask import abort, jsonify, make_response, render_template, request, redirect, send_file
+from flask import abort, jsonify, make_response, render_template, request, redirect
+from psycopg2 import IntegrityError
 
 # -------------------------
 # Local extension libraries
 # -------------------------
 import util.utilities as utils
 
+from util import caching, compression, derivatives, highlighting, quotas, streaming, tasks, uploads, viewer
 from util.blueprints import File, URL, User
-from util.constants import app, cache, config, const, epoch, markdown, postgres
+from util.constants import app, cache, config, const, epoch, objects, pages, postgres, storage, thumbnails, variants, version, workers, writer
 
 
 BASE = "/api"
@@ -82,16 +90,20 @@ def authenticate():
         return utils.respond(code=422,
                              msg="Missing JSON data.")
 
-    if username == const.superuser.username and password == const.superuser.password:
-        return utils.respond(**dict(const.superuser))
-
-    user = utils.first(iterable=cache["users"],
-                       condition=lambda user: user.username == username and user.password == password)
+    user = cache.user_by_username(username=username)
 
-    if user is None:
+    if user is None or user.password != password:
         return utils.respond(code=404,
                              msg="User not found.")
 
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # hashed tokens can't be handed back for the login cookie,
+    # so a signed session is handed out in their place
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    if cache.hash_tokens:
+        return utils.respond(**dict(dict(user),
+                                    token=utils.make_session(user=user)))
+
     return utils.respond(**dict(user))
 
 @app.route(rule=BASE + "/logout")
@@ -121,6 +133,35 @@ def login():
     return redirect(location="/home",
                     code=303), 303
 
+@app.route(rule=BASE + "/stats")
+def stats():
+    """Returns internal performance counters to admins."""
+
+    user = utils.check_user(token=request.headers.get("Authorization"))
+
+    if user is None:
+        return utils.respond(code=403,
+                             msg="Invalid API token.")
+
+    if not user.admin:
+        return utils.respond(code=403,
+                             msg="You can't view server stats.",
+                             needed_permission="admin")
+
+    return utils.respond(code=200,
+                         msg="OK",
+                         postgres=postgres.stats,
+                         writer=writer.stats,
+                         uploads=uploads.stats(),
+                         workers=workers.stats,
+                         thumbnails=thumbnails.stats,
+                         variants=variants.stats,
+                         pages=pages.stats,
+                         objects=objects.stats if objects is not None else None,
+                         cache=dict(bounded=cache.bounded,
+                                    hits=getattr(cache, "hits", None),
+                                    misses=getattr(cache, "misses", None)))
+
 @app.route(rule=BASE + "/shorten",
            methods=["POST"])
 def shorten_url():
@@ -142,8 +183,7 @@ def shorten_url():
         return utils.respond(code=403,
                              msg="Missing JSON data.")
 
-    found_url = utils.first(iterable=cache["urls"],
-                            condition=lambda url: url.url == to_shorten)
+    found_url = cache.url_by_target(target=to_shorten)
 
     if found_url:
         return utils.respond(code=409,
@@ -156,30 +196,37 @@ def shorten_url():
                              msg="That URL is invalid.")
 
     key = request.headers.get("URL-Name")
+    created_at = datetime.utcnow()
 
     if not (user.admin and config.url_shortening.custom_url.admin_only) or not key:
-        key = utils.generate_key(cache_obj="urls")
+        key, url_id = utils.insert_with_key(table="urls",
+                                            owner_id=user.id,
+                                            url=to_shorten,
+                                            created_at=created_at)
 
-    with postgres.cursor() as con:
-        query = """INSERT INTO urls (owner_id, key, url, created_at)
-                   VALUES (%(owner_id)s, %(key)s, %(url)s, %(created_at)s)
-                   
-                   RETURNING id;"""
+    else:
+        if cache.has_url(key=key):
+            return utils.respond(code=409,
+                                 msg="That URL name has already been taken.")
 
-        con.execute(query,
-                    dict(owner_id=user.id,
-                         key=key,
-                         url=to_shorten,
-                         created_at=datetime.utcnow()))
+        try:
+            url_id = writer.insert(table="urls",
+                                   owner_id=user.id,
+                                   key=key,
+                                   url=to_shorten,
+                                   created_at=created_at)
+
+        except IntegrityError:
+            return utils.respond(code=409,
+                                 msg="That URL name has already been taken.")
 
-        url_id = con.fetchone()[0]
-        url_obj = URL(id=url_id,
-                      key=key,
-                      url=to_shorten,
-                      created_at=datetime.utcnow(),
-                      owner=user)
+    url_obj = URL(id=url_id,
+                  key=key,
+                  url=to_shorten,
+                  created_at=created_at,
+                  owner=user)
 
-        cache["urls"].insert(0, url_obj)
+    cache.add_url(url=url_obj)
 
     return f"https://{request.url_root.lstrip('http://')}u/{key}", 200
 
@@ -206,33 +253,92 @@ def upload_file():
         return utils.respond(code=422,
                              msg="Invalid filetype")
 
-    key = f"{utils.generate_key()}.{file.filename.rsplit('.', 1)[1].lower()}"
+    if not quotas.allows(user=user):
+        return utils.respond(code=413,
+                             msg="You've used up your storage quota.")
 
-    file.save(f"static/uploads/{key}")
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the upload is written and hashed before it gets a key, PIL
+    # raises OSError subclasses for images it can't decode
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    try:
+        staged = uploads.stage(stream=file.stream,
+                               optimise=file_type == "image" and not utils.bypass_optimise(header=request.headers.get("Compression-Bypass"),
+                                                                                           user=user))
 
-    if file_type == "image" and not utils.bypass_optimise(header=request.headers.get("Compression-Bypass"),
-                                                          user=user):
-        utils.optimise_image(key=key)
+    except OSError:
+        if file_type != "image":
+            raise
 
-    with postgres.cursor() as con:
-        query = """INSERT INTO files (owner_id, key, created_at)
-                   VALUES (%(owner_id)s, %(key)s, %(created_at)s)
-                   
-                   RETURNING id;"""
-
-        con.execute(query,
-                    dict(owner_id=user.id,
-                         key=key,
-                         created_at=datetime.utcnow()))
-
-        file_id = con.fetchone()[0]
-        file_obj = File(id=file_id,
-                        key=key,
-                        created_at=datetime.utcnow(),
-                        owner=user,
-                        deleted=False)
-
-        cache["files"].insert(0, file_obj)
+        return utils.respond(code=422,
+                             msg="Invalid image data.")
+
+    if not quotas.reserve(user=user,
+                          size=staged.size):
+        uploads.discard(staged=staged)
+
+        return utils.respond(code=413,
+                             msg="This file would take you over your storage quota.")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the row is inserted before the key is linked so that the
+    # key is reserved across every worker process first
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    created_at = datetime.utcnow()
+    metadata = uploads.describe(filename=file.filename,
+                                size=staged.size,
+                                path=staged.path)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # if anything fails, the row (if it was inserted) and the
+    # quota reservation are given back, commit has already let
+    # go of the blob by then
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    file_id = None
+
+    try:
+        key, file_id = utils.insert_with_key(table="files",
+                                             suffix=f".{utils.filext(filename=file.filename)}",
+                                             owner_id=user.id,
+                                             digest=staged.digest,
+                                             created_at=created_at,
+                                             **metadata)
+
+        uploads.commit(staged=staged,
+                       key=key)
+
+    except Exception:
+        uploads.discard(staged=staged)
+
+        if file_id is not None:
+            with postgres.cursor() as con:
+                con.execute("""DELETE FROM files
+                               WHERE id = %(id)s;""",
+                            dict(id=file_id))
+
+        quotas.adjust(owner_id=user.id,
+                      size=-staged.size,
+                      files=-1)
+        raise
+
+    file_obj = File(id=file_id,
+                    key=key,
+                    created_at=created_at,
+                    owner=user,
+                    deleted=False,
+                    digest=staged.digest,
+                    **metadata)
+
+    cache.add_file(file=file_obj)
+
+    if config.thumbnails.at_upload and derivatives.thumbnailable(key=key):
+        derivatives.warm_thumbnail(key=key)
+
+    if config.negotiation.enabled and config.negotiation.at_upload and derivatives.transcodable(key=key):
+        derivatives.warm_transcodes(key=key)
+
+    if config.compression.enabled and compression.compressible(key=key):
+        uploads.precompress(digest=staged.digest)
 
     return f"https://{request.url_root.lstrip('http://')}{'f' if file_type != 'image' else 'i'}/{key}", 200
 
@@ -249,19 +355,14 @@ def delete_url(url_key: str):
         return utils.respond(code=403,
                              msg="Invalid API token.")
 
-    found_url = utils.first(iterable=cache["urls"],
-                            condition=lambda url: url.key == url_key)
+    found_url = cache.get_url(key=url_key)
     
     if found_url is None:
         return utils.respond(code=404,
                              msg="URL not found.")
 
-    # ========================================================
-    # - User isn't admin and isn't trying to delete their file
-    # - Both admin but user is not superuser
-    # ========================================================
-    if (not user.admin and user.id != found_url.owner.id) \
-       or (user.admin and found_url.owner.admin and user.id != found_url.owner.id and user.id != const.superuser.id):
+    if not utils.can_delete(user=user,
+                            owner=found_url.owner):
         return utils.respond(code=403,
                              msg="You don't own this URL.")
 
@@ -272,7 +373,7 @@ def delete_url(url_key: str):
         con.execute(query,
                     dict(key=url_key))
 
-    cache["urls"].remove(found_url)
+    cache.remove_url(url=found_url)
 
     return utils.respond(code=200,
                          msg="URL has been deleted.")
@@ -290,41 +391,273 @@ def delete_file(filename: str):
         return utils.respond(code=403,
                              msg="Invalid API token.")
 
-    file = utils.first(iterable=cache["files"],
-                       condition=lambda file: file.key == filename)
+    file = cache.get_file(key=filename)
     
-    if file is None:
+    if file is None or file.deleted:
         return utils.respond(code=404,
                              msg="File not found.")
 
-    # ========================================================
-    # - User isn't admin and isn't trying to delete their file
-    # - Both admin but user is not superuser
-    # ========================================================
-    if (not user.admin and user.id != file.owner.id) \
-       or (user.admin and file.owner.admin and user.id != file.owner.id and user.id != const.superuser.id):
+    if not utils.can_delete(user=user,
+                            owner=file.owner):
         return utils.respond(code=403,
                              msg="You don't own this file.")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the row is only flagged, the reaper removes the file once
+    # it can no longer be restored. If no row comes back it was
+    # deleted by another request first
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     with postgres.cursor() as con:
-        query = """DELETE FROM files
-                    WHERE key = %(key)s;"""
+        query = """UPDATE files
+                   SET deleted = true, deleted_at = %(deleted_at)s
+                   WHERE key = %(key)s AND deleted IS NOT TRUE
+
+                   RETURNING owner_id, size;"""
 
         con.execute(query,
+                    dict(key=filename,
+                         deleted_at=datetime.utcnow()))
+
+        flagged = con.fetchone()
+
+    file.deleted = True
+
+    if flagged is None:
+        return utils.respond(code=404,
+                             msg="File not found.")
+
+    owner_id, size = flagged
+    quotas.adjust(owner_id=owner_id,
+                  size=-(size or 0),
+                  files=-1)
+
+    return utils.respond(code=200,
+                         msg="File has been deleted.",
+                         undo_seconds=config.deletion.undo_seconds)
+
+@app.route(rule=BASE + "/restore/f/<filename>",
+           methods=["POST"])
+def restore_file(filename: str):
+    """Restores a deleted file with a given filename, if it hasn't been reaped yet.
+
+    The same checks as deleting the file are run on the user's token."""
+
+    user = utils.check_user(token=request.headers.get("Authorization"))
+
+    if user is None:
+        return utils.respond(code=403,
+                             msg="Invalid API token.")
+
+    file = cache.get_file(key=filename)
+
+    if file is None:
+        return utils.respond(code=404,
+                             msg="File not found.")
+
+    if not utils.can_delete(user=user,
+                            owner=file.owner):
+        return utils.respond(code=403,
+                             msg="You don't own this file.")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the reaper deletes the row once the undo window is over,
+    # so a row that's still there and flagged can be restored.
+    # It stays locked until it's restored, so the reaper can't
+    # take it in the meantime
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    with postgres.transaction() as con:
+        con.execute("""SELECT owner_id, size
+                       FROM files
+                       WHERE key = %(key)s AND deleted AND deleted_at > %(cutoff)s
+
+                       FOR UPDATE;""",
+                    dict(key=filename,
+                         cutoff=datetime.utcnow() - timedelta(seconds=config.deletion.undo_seconds)))
+
+        row = con.fetchone()
+
+        if row is None and not file.deleted:
+            return utils.respond(code=409,
+                                 msg="This file hasn't been deleted.")
+
+        if row is None:
+            return utils.respond(code=410,
+                                 msg="This file can no longer be restored.")
+
+        owner_id, size = row
+        owner = cache.user_by_id(id=owner_id)
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # the file counts against its owner's quota again, so room
+        # is reserved just as it is for a new upload. An owner that
+        # was removed has no quota, only its counters are kept up
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        if owner is None:
+            quotas.adjust(owner_id=owner_id,
+                          size=size or 0,
+                          files=1)
+
+        elif not quotas.reserve(user=owner,
+                                size=size or 0):
+            return utils.respond(code=413,
+                                 msg="Restoring this file would take its owner over their storage quota.")
+
+        con.execute("""UPDATE files
+                       SET deleted = false, deleted_at = NULL
+                       WHERE key = %(key)s;""",
                     dict(key=filename))
 
-    os.remove(path=f"static/uploads/{filename}")
-    cache["files"].remove(file)
+    file.deleted = False
 
     return utils.respond(code=200,
-                         msg="File has been deleted.")
+                         msg="File has been restored.")
+
+@app.route(rule=BASE + "/delete/bulk",
+           methods=["DELETE", "POST"])
+def bulk_delete():
+    """Deletes many files and URLs at once.
+
+    The body is a JSON object with lists of file keys under "files" and URL keys under "urls". Each key is checked just as
+    delete_file and delete_url check one, then every allowed file is flagged with one UPDATE and every allowed URL removed
+    with one DELETE. The response holds the outcome of each key, which is 404 for any key those statements didn't return
+    (e.g: a file that was already deleted), just as it is for a single delete."""
+
+    user = utils.check_user(token=request.headers.get("Authorization"))
+
+    if user is None:
+        return utils.respond(code=403,
+                             msg="Invalid API token.")
+
+    body = request.get_json(silent=True) or {}
+    file_keys = body.get("files", [])
+    url_keys = body.get("urls", [])
+
+    if not isinstance(file_keys, list) or not isinstance(url_keys, list) \
+       or not all(isinstance(key, str) for key in file_keys + url_keys):
+        return utils.respond(code=422,
+                             msg="files and urls must be lists of keys.")
+
+    if len(file_keys) + len(url_keys) > config.deletion.max_bulk_keys:
+        return utils.respond(code=413,
+                             msg=f"At most {config.deletion.max_bulk_keys} keys can be deleted at once.")
+
+    results = dict(files={},
+                   urls={})
+    flagged = []
+    removed = set()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # keys are checked one by one against the registry, which may
+    # read them from Postgres when it's bounded, so duplicates are
+    # dropped first to only look each key up once
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    files = []
+
+    for key in dict.fromkeys(file_keys):
+        file = cache.get_file(key=key)
+
+        if file is None or file.deleted:
+            results["files"][key] = dict(code=404,
+                                         message="File not found.")
+
+        elif not utils.can_delete(user=user,
+                                  owner=file.owner):
+            results["files"][key] = dict(code=403,
+                                         message="You don't own this file.")
+
+        else:
+            files.append(file)
+
+    urls = []
+
+    for key in dict.fromkeys(url_keys):
+        found_url = cache.get_url(key=key)
+
+        if found_url is None:
+            results["urls"][key] = dict(code=404,
+                                        message="URL not found.")
+
+        elif not utils.can_delete(user=user,
+                                  owner=found_url.owner):
+            results["urls"][key] = dict(code=403,
+                                        message="You don't own this URL.")
+
+        else:
+            urls.append(found_url)
+
+    if files:
+        with postgres.cursor() as con:
+            query = """UPDATE files
+                       SET deleted = true, deleted_at = %(deleted_at)s
+                       WHERE key = ANY(%(keys)s) AND deleted IS NOT TRUE
+
+                       RETURNING key, owner_id, size;"""
+
+            con.execute(query,
+                        dict(keys=[file.key for file in files],
+                             deleted_at=datetime.utcnow()))
+
+            flagged = con.fetchall()
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # files the UPDATE didn't return were deleted by another
+        # request first. Quotas are adjusted once per owner, as
+        # owner ID: [bytes, files] freed
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        freed = {}
+
+        for file in files:
+            file.deleted = True
+            results["files"][file.key] = dict(code=404,
+                                              message="File not found.")
+
+        for key, owner_id, size in flagged:
+            results["files"][key] = dict(code=200,
+                                         message="File has been deleted.")
+
+            totals = freed.setdefault(owner_id, [0, 0])
+            totals[0] += size or 0
+            totals[1] += 1
+
+        for owner_id, (size, count) in freed.items():
+            quotas.adjust(owner_id=owner_id,
+                          size=-size,
+                          files=-count)
+
+    if urls:
+        with postgres.cursor() as con:
+            query = """DELETE FROM urls
+                       WHERE key = ANY(%(keys)s)
+
+                       RETURNING key;"""
+
+            con.execute(query,
+                        dict(keys=[found_url.key for found_url in urls]))
+
+            removed = {row[0] for row in con.fetchall()}
+
+        cache.remove_urls(urls=urls)
+
+        for found_url in urls:
+            if found_url.key in removed:
+                results["urls"][found_url.key] = dict(code=200,
+                                                      message="URL has been deleted.")
+
+            else:
+                results["urls"][found_url.key] = dict(code=404,
+                                                      message="URL not found.")
+
+    return utils.respond(code=200,
+                         msg=f"Deleted {len(flagged)} files and {len(removed)} URLs.",
+                         undo_seconds=config.deletion.undo_seconds,
+                         results=results)
 
 @app.route(rule=BASE + "/u/<link>")
 @app.route(rule="/u/<link>")
 def get_link(link: str):
     """Redirects a user to a shortened URL if it exists."""
 
-    found_url = utils.first(iterable=cache["urls"],
-                            condition=lambda url: url.key == link)
+    found_url = cache.get_url(key=link)
 
     if found_url is None:
         abort(status=404)
@@ -332,78 +665,415 @@ def get_link(link: str):
     return redirect(location=found_url.url,
                     code=303), 303
 
+def send_stored(path: str,
+                file: File,
+                variant: Optional[str] = "",
+                mimetype: Optional[str] = None,
+                as_attachment: Optional[bool] = False,
+                encodable: Optional[bool] = False):
+    """Sends a stored file with validators and an immutable Cache-Control header, or a 304 if the client's copy is current.
+
+    Byte ranges are honoured, so media can be seeked and downloads resumed. If encodable is set, the best of the upload's
+    precompressed sidecars that the client accepts is sent in its place."""
+
+    mimetype = mimetype or (file.mimetype if file is not None else None) or guess_type(url=path)[0] or "application/octet-stream"
+    download_name = os.path.basename(path) if as_attachment else None
+    encoding = None
+
+    if encodable and file is not None and file.digest is not None:
+        blob_path = uploads.blob_path(digest=file.digest)
+        encoding = compression.negotiate(available=compression.sidecars(path=blob_path))
+
+        if encoding is not None:
+            path = compression.sidecar(path=blob_path,
+                                       encoding=encoding)
+            variant += f":{encoding}"
+
+    etag, last_modified = caching.validators(path=path,
+                                             file=file,
+                                             variant=variant)
+
+    if caching.is_fresh(etag=etag,
+                        last_modified=last_modified):
+        response = caching.not_modified(etag=etag,
+                                        last_modified=last_modified,
+                                        max_age=config.caching.max_age,
+                                        immutable=True)
+
+    else:
+        response = caching.cacheable(response=streaming.send_ranges(path=path,
+                                                                    mimetype=mimetype,
+                                                                    etag=etag,
+                                                                    last_modified=last_modified,
+                                                                    download_name=download_name),
+                                     etag=etag,
+                                     last_modified=last_modified,
+                                     max_age=config.caching.max_age,
+                                     immutable=True)
+
+    if encodable:
+        response.vary.add("Accept-Encoding")
+
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+
+    return response
+
+def send_upload(key: str,
+                file: File,
+                variant: Optional[str] = "",
+                as_attachment: Optional[bool] = False,
+                encodable: Optional[bool] = False):
+    """Sends an upload as it was uploaded, from the local disk or streamed from a remote storage backend.
+
+    Remote uploads are sent the same way as send_stored sends local ones, byte ranges included, except that they never
+    have precompressed sidecars."""
+
+    path = uploads.locate(key=key)
+
+    if path is not None:
+        return send_stored(path=path,
+                           file=file,
+                           variant=variant,
+                           as_attachment=as_attachment,
+                           encodable=encodable)
+
+    stat = uploads.stat(key=key,
+                        file=file)
+
+    if stat is None:
+        abort(status=404)
+
+    etag, last_modified = caching.validators(file=file,
+                                             variant=variant,
+                                             stat=stat)
+
+    if caching.is_fresh(etag=etag,
+                        last_modified=last_modified):
+        return caching.not_modified(etag=etag,
+                                    last_modified=last_modified,
+                                    max_age=config.caching.max_age,
+                                    immutable=True)
+
+    return caching.cacheable(response=streaming.send_object_ranges(storage=storage,
+                                                                   name=file.digest,
+                                                                   size=stat.st_size,
+                                                                   mimetype=file.mimetype or guess_type(url=key)[0] or "application/octet-stream",
+                                                                   etag=etag,
+                                                                   last_modified=last_modified,
+                                                                   download_name=key if as_attachment else None),
+                             etag=etag,
+                             last_modified=last_modified,
+                             max_age=config.caching.max_age,
+                             immutable=True)
+
+def send_image(key: str,
+               name: str,
+               path: str):
+    """Sends an image, transcoded to a smaller format if the client accepts one.
+
+    The response varies on the Accept header whether or not it was transcoded, so shared caches keep the formats apart.
+    The chosen format is part of the ETag, and a client with a current copy gets a 304 before anything is transcoded."""
+
+    file = cache.get_file(key=key)
+    mimetype = derivatives.negotiate(key=key,
+                                     accept=request.accept_mimetypes)
+
+    etag, last_modified = caching.validators(path=path,
+                                             file=file,
+                                             variant=f"{name}:{mimetype}")
+
+    if caching.is_fresh(etag=etag,
+                        last_modified=last_modified):
+        response = caching.not_modified(etag=etag,
+                                        last_modified=last_modified,
+                                        max_age=config.caching.max_age,
+                                        immutable=True)
+
+    else:
+        if mimetype is not None:
+            path, mimetype = derivatives.transcode(name=name,
+                                                   source=path,
+                                                   mimetype=mimetype)
+
+        response = caching.cacheable(response=streaming.send_ranges(path=path,
+                                                                    mimetype=mimetype or guess_type(url=key)[0],
+                                                                    etag=etag,
+                                                                    last_modified=last_modified),
+                                     etag=etag,
+                                     last_modified=last_modified,
+                                     max_age=config.caching.max_age,
+                                     immutable=True)
+
+    response.vary.add("Accept")
+
+    return response
+
+@app.route(rule=BASE + "/r/<filename>")
+@app.route(rule="/r/<filename>")
+@app.route(rule="/static/uploads/<filename>")
+def get_raw_file(filename: str):
+    """Gets and returns the contents of a file as they were uploaded, if it exists.
+
+    This also answers the old /static/uploads/<filename> URLs, since uploads may no longer be stored flat in that folder."""
+
+    file = cache.get_file(key=filename)
+
+    if file is not None and file.deleted:
+        abort(status=404)
+
+    if "download" in request.args:
+        return send_upload(key=filename,
+                           file=file,
+                           variant="download",
+                           as_attachment=True,
+                           encodable=compression.compressible(key=filename))
+
+    if derivatives.transcodable(key=filename):
+        path = uploads.fetch(key=filename)
+
+        if path is None:
+            abort(status=404)
+
+        try:
+            return send_image(key=filename,
+                              name=f"{filename}@original",
+                              path=path)
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # the upload couldn't be decoded, so it's sent as it is
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        except OSError:
+            pass
+
+    return send_upload(key=filename,
+                       file=file,
+                       encodable=compression.compressible(key=filename))
+
 @app.route(rule=BASE + "/f/<filename>")
 @app.route(rule="/f/<filename>")
 @app.route(rule="/i/<filename>")
 def get_file(filename: str):
     """Gets and returns an file if it exists."""
 
-    path = f"static/uploads/{filename}"
+    file_obj = cache.get_file(key=filename)
+    stat = uploads.stat(key=filename,
+                        file=file_obj)
 
-    if not os.path.exists(path):
+    if stat is None or (file_obj is not None and file_obj.deleted):
         abort(status=404)
 
     file_type = utils.filetype(filename=filename)
 
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # a query string (e.g: ?w=640&fit=cover) asks for a resized
+    # copy of the image itself instead of the embed page
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    if file_type == "image" and any(parameter in request.args for parameter in derivatives.VARIANT_PARAMETERS):
+        try:
+            options = derivatives.variant_options(args=request.args)
+
+        except ValueError as error:
+            return utils.respond(code=400,
+                                 msg=str(error))
+
+        try:
+            variant_path = derivatives.variant(key=filename,
+                                               **options)
+
+            return send_image(key=filename,
+                              name=os.path.basename(variant_path),
+                              path=variant_path)
+
+        except OSError:
+            abort(status=404)
+
     if file_type == "gif":
         file_type = "image"
 
     if file_type == "download":
-        return send_file(filename_or_fp=path, 
-                         as_attachment=True)
+        return send_upload(key=filename,
+                           file=file_obj,
+                           variant="download",
+                           as_attachment=True)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # pages are revalidated rather than cached for good, since they
+    # change with templates and releases, which is why the version
+    # is part of their ETag. Compressed and uncompressed pages are
+    # different responses, so the negotiated coding is part of it
+    # too
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    number = request.args.get("page", default=1, type=int)
+    encoding = compression.negotiate()
+    etag, last_modified = caching.validators(file=file_obj,
+                                             variant=f"page:{version.hash}:{number}:{encoding}",
+                                             stat=stat)
+
+    if caching.is_fresh(etag=etag,
+                        last_modified=last_modified):
+        response = caching.not_modified(etag=etag,
+                                        last_modified=last_modified,
+                                        max_age=config.caching.page_max_age)
+        response.vary.add("Accept-Encoding")
+
+        return response
+
+    response = compression.compress_response(response=make_response(cached_page(stat=stat,
+                                                                                filename=filename,
+                                                                                file_type=file_type,
+                                                                                file=file_obj,
+                                                                                number=number)),
+                                             encoding=encoding)
+
+    return caching.cacheable(response=response,
+                             etag=etag,
+                             last_modified=last_modified,
+                             max_age=config.caching.page_max_age)
+
+def cached_page(stat: Any,
+                filename: str,
+                file_type: str,
+                file: File,
+                number: int) -> str:
+    """Returns the page a file is viewed on, from the page cache if it has already been rendered.
+
+    Only text, code and markdown pages are cached, the rest are cheap enough to render every time. The cache holds
+    one page number per file, which is almost always the first."""
+
+    if file_type not in ("text", "code", "markdown"):
+        return render_page(stat=stat,
+                           filename=filename,
+                           file_type=file_type,
+                           file=file,
+                           number=number)
+
+    stamp = f"{stat.st_mtime_ns:x}-{version.hash}-{number}"
+    page = pages.get(key=filename,
+                     stamp=stamp)
+
+    if page is None:
+        page = render_page(stat=stat,
+                           filename=filename,
+                           file_type=file_type,
+                           file=file,
+                           number=number)
+
+        pages.put(key=filename,
+                  stamp=stamp,
+                  page=page)
+
+    return page
+
+def render_page(stat: Any,
+                filename: str,
+                file_type: str,
+                file: File,
+                number: int) -> str:
+    """Renders the page a file is viewed on.
+
+    Text and code files are read one page (a window of lines) at a time, so viewing a huge file never loads all of it.
+    Markdown has to be rendered whole, so markdown files too big for that are shown a page at a time as plain text.
+    Only these need the upload's contents, which are fetched from the storage backend if it's remote."""
+
+    size = utils.bytes_4_humans(count=stat.st_size)
+
+    if file_type not in ("text", "code", "markdown"):
+        return render_template(template_name_or_list=f"files/{file_type}.html",
+                               file=file,
+                               config=config.meta,
+                               size=size)
+
+    path = uploads.fetch(key=filename)
+
+    if path is None:
+        abort(status=404)
+
+    if file_type == "markdown" and viewer.paginated(path=path):
+        file_type = "text"
 
     if file_type == "text":
-        with open(file=path) as file:
-            content = file.read()
+        page = viewer.read_page(path=path,
+                                number=number)
 
         return render_template(template_name_or_list="files/text.html",
-                               file=utils.first(iterable=cache.files,
-                                                condition=lambda f: f.key == filename),
+                               file=file,
                                config=config.meta,
-                               content=content,
-                               size=utils.bytes_4_humans(count=os.path.getsize(filename=path)))
+                               content=page.content,
+                               page=page,
+                               size=size)
 
     if file_type == "code":
-        with open(file=path) as file:
-            content = file.read()
+        page = viewer.read_page(path=path,
+                                number=number)
 
         file_ext = utils.filext(filename=filename)
-        lang = {
-            "py": "python",
-            "js": "javascript",
-            "go": "go",
-            "ts": "typescript",
-            "cpp": "cpp",
-            "html": "html",
-            "css": "css",
-            "json": "json"
-        }.get(file_ext)
+        lang = highlighting.language(extension=file_ext)
 
         return render_template(template_name_or_list="files/code.html",
-                               file=utils.first(iterable=cache.files,
-                                                condition=lambda f: f.key == filename),
+                               file=file,
                                config=config.meta,
-                               content=markdown(f"```{lang}\n{content}\n```"),
-                               size=utils.bytes_4_humans(count=os.path.getsize(filename=path)),
+                               content=workers.run(tasks.highlight_code, page.content, lang, page.first_line),
+                               page=page,
+                               size=size,
                                lang=lang,
                                lang_ext=file_ext)
 
-    if file_type == "markdown":
-        with open(file=path) as file:
-            content = file.read()
+    with open(file=path) as source:
+        content = source.read()
 
-        return render_template(template_name_or_list="files/markdown.html",
-                               file=utils.first(iterable=cache.files,
-                                                condition=lambda f: f.key == filename),
-                               config=config.meta,
-                               content=markdown(content),
-                               size=utils.bytes_4_humans(count=os.path.getsize(filename=path)))
-
-    return render_template(template_name_or_list=f"files/{file_type}.html",
-                           file=utils.first(iterable=cache.files,
-                                            condition=lambda f: f.key == filename),
+    return render_template(template_name_or_list="files/markdown.html",
+                           file=file,
                            config=config.meta,
-                           size=utils.bytes_4_humans(count=os.path.getsize(filename=path)))
+                           content=workers.run(tasks.render_markdown, content),
+                           size=size)
+
+@app.route(rule="/highlight.css")
+def highlight_stylesheet():
+    """Returns the stylesheet for highlighted code in the configured style.
+
+    Pages link to it with the stylesheet's version in the query string, so it can be cached for good."""
+
+    etag = highlighting.stylesheet_version(style=config.code_style)
+    last_modified = const.boot_dt.replace(microsecond=0)
+
+    if caching.is_fresh(etag=etag,
+                        last_modified=last_modified):
+        return caching.not_modified(etag=etag,
+                                    last_modified=last_modified,
+                                    max_age=config.caching.max_age,
+                                    immutable=True)
+
+    return caching.cacheable(response=make_response(highlighting.stylesheet(style=config.code_style), 200, {"Content-Type": "text/css; charset=utf-8"}),
+                             etag=etag,
+                             last_modified=last_modified,
+                             max_age=config.caching.max_age,
+                             immutable=True)
+
+@app.route(rule=BASE + "/t/<filename>")
+@app.route(rule="/t/<filename>")
+def get_thumbnail(filename: str):
+    """Gets and returns a small JPEG preview of an image if it exists."""
+
+    file = cache.get_file(key=filename)
+
+    if not derivatives.thumbnailable(key=filename) or (file is not None and file.deleted) or uploads.stat(key=filename, file=file) is None:
+        abort(status=404)
+
+    try:
+        path = derivatives.thumbnail(key=filename)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # uploads that bypassed optimisation were never decoded, so
+    # they might not be valid images
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    except OSError:
+        abort(status=404)
+
+    return send_stored(path=path,
+                       file=file,
+                       variant="thumbnail",
+                       mimetype="image/jpeg")
 
 @app.route(rule=BASE + "/user/new",
            methods=["PUT", "POST"])
@@ -446,15 +1116,16 @@ def new_user():
                              msg="You can't create admin users.",
                              needed_permission="superuser")
 
-    if request.json.get("username") in (u.username for u in cache["users"]):
+    if cache.user_by_username(username=request.json.get("username")) is not None:
         return utils.respond(code=409,
                              msg="That username has already been taken.")
 
+    token = utils.generate_token()
     stripped_values = dict(username=request.json.get("username"),
                            password=request.json.get("password"),
                            admin=request.json.get("admin"),
                            created_at=datetime.utcnow(),
-                           token=utils.generate_token())
+                           token=utils.store_token(token=token))
 
     with postgres.cursor() as con:
         query = """INSERT INTO users (username, password, admin, token, created_at)
@@ -469,11 +1140,12 @@ def new_user():
         user_obj = User(id=id,
                         **stripped_values)
 
-        cache["users"].append(user_obj)
+        cache.add_user(user=user_obj)
 
     return utils.respond(code=200,
                          msg="User has been created.",
-                         id=id)
+                         id=id,
+                         token=token)
 
 @app.route(rule=BASE + "/user/delete",
            methods=["DELETE", "POST"])
@@ -516,7 +1188,7 @@ def delete_user():
         con.execute(query,
                     dict(id=victim.id))
 
-        cache["users"].remove(victim)
+        cache.remove_user(user=victim)
 
     return utils.respond(code=200,
                          msg="User has been deleted.")
@@ -568,7 +1240,9 @@ def edit_user():
         # --------------------------------------
         # Ignore if the victim has this username
         # --------------------------------------
-        if new_stuff.get("username") in (u.username for u in cache["users"] if u.id != victim.id):
+        taken_by = cache.user_by_username(username=new_stuff.get("username"))
+
+        if taken_by is not None and taken_by.id != victim.id:
             return utils.respond(code=409,
                                  msg="Username has been taken.")
 
@@ -590,6 +1264,9 @@ def edit_user():
                       
     new_values.update(new_stuff)
 
+    if "token" in new_stuff:
+        new_values["token"] = utils.store_token(token=new_stuff.get("token"))
+
     with postgres.cursor() as con:
         query = """UPDATE users
                    SET username = %(username)s,
@@ -602,11 +1279,24 @@ def edit_user():
                     dict(id=victim.id, 
                          **new_values))
 
-        new_obj = User(id=victim.id,
-                       created_at=victim.created_at,
-                       **new_values)
-
-        cache["users"][cache["users"].index(victim)] = new_obj
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # the victim is edited in place so that any files or URLs
+        # they own keep pointing at their up to date data
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        cache.update_user(user=victim,
+                          username=new_values["username"],
+                          password=new_values["password"],
+                          admin=new_values["admin"],
+                          token=new_values["token"])
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the stored token may be a hash, so only a token the
+    # caller supplied is echoed back, as they supplied it
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    del new_values["token"]
+
+    if "token" in new_stuff:
+        new_values["token"] = new_stuff.get("token")
 
     return utils.respond(code=200,
                          msg="User has been edited.",
@@ -654,16 +1344,15 @@ def reset_token():
                    WHERE id = %(id)s;"""
 
         con.execute(query,
-                    dict(token=new_token,
+                    dict(token=utils.store_token(token=new_token),
                          id=victim.id))
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        # our task of updating the cache is easy here,
-        # all we have to do is change the variable of victim
-        # because the victim variable points directly to cache
-        # and isn't a deep or shallow copy
+        # the victim variable points directly to the cached
+        # user, so the registry only has to re-index the token
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        victim.token = new_token
+        cache.update_user(user=victim,
+                          token=utils.store_token(token=new_token))
                           
     return utils.respond(code=200,
                          msg="Token has been reset.",
@@ -19,6 +19,7 @@ from flask import render_template
 # Local extension libraries
 # -------------------------
 from util.constants import app
+from util.workers import WorkerPoolFull
 
 
 ERRORS = {
@@ -100,4 +101,12 @@ def unavailable_service(error: Any):
     
     It'll often be the result of ongoing maintenance or construction within that section of the site."""
 
+    return _(code=503)
+
+@app.errorhandler(code_or_exception=WorkerPoolFull)
+def workers_busy(error: Any):
+    """This error handler is activated when every worker process is busy and the task queue is full.
+
+    Rather than letting requests pile up, we tell the client to try again later."""
+
     return _(code=503)
\ No newline at end of file
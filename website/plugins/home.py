@@ -14,6 +14,7 @@ from flask import render_template, request, redirect
 # -------------------------
 import util.utilities as utils
 
+from util import quotas
 from util.constants import app, cache, config, const
 
 
@@ -30,7 +31,10 @@ def account_page():
 
     return render_template(template_name_or_list="home/account.html",
                            user=user,
-                           superuser=user.id == const.superuser.id)
+                           superuser=user.id == const.superuser.id,
+                           token_hashed=cache.hash_tokens,
+                           usage=quotas.usage_of(user=user),
+                           limits=quotas.limits_of(user=user))
 
 @app.route(rule="/files")
 @app.route(rule="/home/files")
@@ -45,8 +49,8 @@ def files_page():
 
     return render_template(template_name_or_list="home/files.html",
                            user=user,
-                           files=utils.all(iterable=cache.files,
-                                           condition=lambda file: file.owner.id == user.id and not file.deleted))
+                           files=utils.all(iterable=cache.files_of(owner=user),
+                                           condition=lambda file: not file.deleted))
 
 @app.route(rule="/urls")
 @app.route(rule="/home/urls")
@@ -61,8 +65,7 @@ def shortened_urls():
 
     return render_template(template_name_or_list="home/urls.html",
                            user=user,
-                           urls=utils.all(iterable=cache.urls,
-                                          condition=lambda url: url.owner.id == user.id))
+                           urls=list(cache.urls_of(owner=user)))
 
 @app.route(rule="/urls/new")
 @app.route(rule="/home/urls/new")
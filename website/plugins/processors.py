@@ -7,12 +7,16 @@
 # ------------------------
 # Third-party dependencies
 # ------------------------
-from flask import request, Response
+from flask import request, Response, url_for
 
 # -------------------------
 # Local extension libraries
 # -------------------------
+import util.utilities as utils
+
+from util import highlighting
 from util.constants import app, config, version
+from util.derivatives import thumbnailable
 
 
 @app.context_processor
@@ -23,4 +27,8 @@ def inject_globals():
 
     return dict(version=dict(version),
                 len=len,
-                enumerate=enumerate)
\ No newline at end of file
+                enumerate=enumerate,
+                thumbnailable=thumbnailable,
+                bytes_4_humans=utils.bytes_4_humans,
+                highlight_stylesheet=url_for(endpoint="highlight_stylesheet",
+                                             v=highlighting.stylesheet_version(style=config.code_style)))
\ No newline at end of file
@@ -33,7 +33,7 @@ from typing import Optional
 import os.path
 
 from atexit import register
-from os import _exit, listdir, makedirs
+from os import _exit, listdir
 from platform import system
 from sys import argv
 
@@ -41,20 +41,24 @@ from sys import argv
 # Third-party dependencies
 # ------------------------
 from flask import Flask
+from gevent import spawn
 from gevent.pywsgi import WSGIServer
 from pyfiglet import FontNotFound, print_figlet
-from psycopg2 import connect
 
 # -------------------------
 # Local extension libraries
 # -------------------------
-import util.utilities as utils
-
 from custos import blueprint
 
-from util import console, constants
+from util import console, constants, loader, quotas, reaper, uploads
 from util.constants import cache, config
-from util.blueprints import File, URL, User
+from util.database import Pool
+from util.pages import PageCache, PAGE_DIR
+from util.streaming import SendfileHandler
+from util import storage
+from util.derivatives import DerivativeCache, THUMBNAIL_DIR, VARIANT_DIR
+from util.workers import WorkerPool
+from util.writer import BatchWriter
 
 
 constants.app = app = Flask(import_name="Imago")
@@ -65,6 +69,10 @@ class Imago(blueprint):
         """This runs some code before we quietly close down."""
         
         console.fatal(text="Shutting down...")
+
+        if constants.workers is not None:
+            constants.workers.shutdown()
+
         self.print_fig(stop=True)
 
     def print_fig(self,
@@ -99,73 +107,68 @@ class Imago(blueprint):
     def postgres_init(self):
         """Initialises the connection to the PostgreSQL server."""
 
-        constants.postgres = connect(dsn="user={pg.user} password={pg.password} host={pg.host} port={pg.port} dbname={pg.database}".format(pg=config.postgres))
+        pool_config = config.postgres.pool
+
+        constants.postgres = Pool(dsn="user={pg.user} password={pg.password} host={pg.host} port={pg.port} dbname={pg.database}".format(pg=config.postgres),
+                                  min_size=pool_config.min_size,
+                                  max_size=pool_config.max_size,
+                                  health_check_interval=pool_config.health_check_interval,
+                                  acquire_timeout=pool_config.acquire_timeout)
         console.info(text="Connected to Postgres server at: {pg.user}@{pg.host}/{pg.database}".format(pg=config.postgres))
-        constants.postgres.set_session(autocommit=True)
 
-        # =================================
-        # Create the required schema tables
-        # =================================
-        with constants.postgres.cursor() as con:
-            queries = ("""CREATE TABLE IF NOT EXISTS users (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, admin BOOLEAN, token TEXT, created_at TIMESTAMP);""",
-                       """CREATE TABLE IF NOT EXISTS files (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, deleted BOOLEAN, created_at TIMESTAMP);""",
-                       """CREATE TABLE IF NOT EXISTS urls (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, url TEXT, created_at TIMESTAMP);""")
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # pooled connections are autocommit, but cache population needs
+        # a transaction for its named cursors, so we borrow one and
+        # switch autocommit back on before handing it back to the pool
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        with constants.postgres.connection() as connection:
+            connection.autocommit = False
 
-            for query in queries:
-                con.execute(query)
-                constants.postgres.commit()
+            # =================================
+            # Create the required schema tables
+            # =================================
+            with connection.cursor() as con:
+                queries = ("""CREATE TABLE IF NOT EXISTS users (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, admin BOOLEAN, token TEXT, created_at TIMESTAMP);""",
+                           """CREATE TABLE IF NOT EXISTS files (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, deleted BOOLEAN, created_at TIMESTAMP);""",
+                           """CREATE TABLE IF NOT EXISTS urls (id SERIAL PRIMARY KEY, owner_id INT, key TEXT UNIQUE, url TEXT, created_at TIMESTAMP);""",
+                           """CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size BIGINT, refs INT);""",
+                           """CREATE TABLE IF NOT EXISTS usage (owner_id INT PRIMARY KEY, bytes BIGINT, files INT);""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS digest TEXT;""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS size BIGINT;""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS mimetype TEXT;""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS width INT;""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS height INT;""",
+                           """ALTER TABLE files ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;""",
+                           """DROP INDEX IF EXISTS files_created_at;""",
+                           """DROP INDEX IF EXISTS urls_created_at;""",
+                           """DROP INDEX IF EXISTS files_owner_id;""",
+                           """DROP INDEX IF EXISTS urls_owner_id;""",
+                           """CREATE INDEX IF NOT EXISTS files_created_at_id ON files (created_at, id);""",
+                           """CREATE INDEX IF NOT EXISTS urls_created_at_id ON urls (created_at, id);""",
+                           """CREATE INDEX IF NOT EXISTS files_owner_id_created_at ON files (owner_id, created_at, id);""",
+                           """CREATE INDEX IF NOT EXISTS files_deleted_at ON files (deleted_at) WHERE deleted;""",
+                           """CREATE INDEX IF NOT EXISTS urls_owner_id_created_at ON urls (owner_id, created_at, id);""",
+                           """CREATE INDEX IF NOT EXISTS urls_url ON urls (url);""")
+
+                for query in queries:
+                    con.execute(query)
+                    connection.commit()
 
             # =================================
             # Populate file, url and user cache
             # =================================
             console.verbose(text="Beginning cache population...")
-            console.verbose(text="Populating user cache...")
-            query = """SELECT id, username, password, admin, token, created_at
-                       FROM users
-                       ORDER BY id ASC;"""
-
-            con.execute(query)
-
-            for user in con.fetchall():
-                cache["users"].append(User(id=user[0],
-                                           username=user[1],
-                                           password=user[2],
-                                           admin=user[3],
-                                           token=user[4],
-                                           created_at=user[5]))
-                console.verbose(text=f"Populated cache for user {user[0]} ({user[1]}).")
-
-            console.verbose(text="Populating file cache...")
-            query = """SELECT id, owner_id, key, deleted, created_at
-                       FROM files
-                       ORDER BY created_at DESC;"""
-
-            con.execute(query)
-
-            for file in con.fetchall():
-                cache["files"].append(File(id=file[0],
-                                        key=file[2],
-                                        deleted=file[3],
-                                        created_at=file[4],
-                                        owner=utils.first(iterable=cache["users"],
-                                                          condition=lambda user: user.id == file[1])))
-                console.verbose(text=f"Populated cache for file {file[0]} ({file[2]}).")
-
-            console.verbose(text="Populating URL cache...")
-            query = """SELECT id, owner_id, key, url, created_at
-                       FROM urls
-                       ORDER BY created_at DESC;"""
-
-            con.execute(query)
-
-            for url in con.fetchall():
-                cache["urls"].append(URL(id=url[0],
-                                         key=url[2],
-                                         url=url[3],
-                                         created_at=url[4],
-                                         owner=utils.first(iterable=cache["users"],
-                                                           condition=lambda user: user.id == url[1])))
-                console.verbose(text=f"Populated cache for url {url[0]} ({url[2]}).")
+            loader.populate(connection=connection,
+                            registry=cache)
+            quotas.populate(connection=connection)
+
+            connection.autocommit = True
+
+        cache.database = constants.postgres
+        constants.writer = BatchWriter(database=constants.postgres,
+                                       enabled=config.writer.enabled,
+                                       max_rows=config.writer.max_rows,
+                                       max_delay=config.writer.max_delay)
 
     def boot(self,
              host: Optional[str] = "127.0.0.1",
@@ -175,8 +178,7 @@ class Imago(blueprint):
         # ===========================
         # Create required directories
         # ===========================
-        makedirs(name="static/uploads", 
-                 exist_ok=True)
+        uploads.prepare()
         
         # =====================
         # Register exit handler
@@ -194,6 +196,39 @@ class Imago(blueprint):
                                                                                                                        error=error))
             _exit(status=2)
 
+        # ==========================
+        # Start worker process pool
+        # ==========================
+        constants.workers = WorkerPool(enabled=config.workers.enabled,
+                                       processes=config.workers.processes,
+                                       max_pending=config.workers.max_pending,
+                                       queue_timeout=config.workers.queue_timeout)
+
+        # ==============================
+        # Connect to the storage backend
+        # ==============================
+        constants.storage = storage.create(config=config.storage,
+                                           root=uploads.BLOB_DIR)
+
+        if not constants.storage.local:
+            constants.objects = DerivativeCache(directory=uploads.OBJECT_DIR,
+                                                max_bytes=config.storage.cache_megabytes * 1024**2)
+
+        # =====================================
+        # Load the thumbnail and variant caches
+        # =====================================
+        constants.thumbnails = DerivativeCache(directory=THUMBNAIL_DIR,
+                                               max_bytes=config.thumbnails.max_megabytes * 1024**2)
+        constants.variants = DerivativeCache(directory=VARIANT_DIR,
+                                             max_bytes=config.variants.max_megabytes * 1024**2)
+
+        # ============================
+        # Load the rendered page cache
+        # ============================
+        constants.pages = PageCache(max_bytes=config.pages.max_megabytes * 1024**2,
+                                    store=DerivativeCache(directory=PAGE_DIR,
+                                                          max_bytes=config.pages.disk_max_megabytes * 1024**2) if config.pages.persist else None)
+
         # ==================
         # Initialise plugins
         # ==================
@@ -207,6 +242,31 @@ class Imago(blueprint):
 
                 _exit(status=2)
 
+        # =======================================
+        # Move flat uploads to the sharded layout
+        # =======================================
+        if config.uploads.migration.background:
+            spawn(uploads.migrate_layout,
+                  batch_size=config.uploads.migration.batch_size,
+                  pause=config.uploads.migration.pause)
+
+        # ====================================
+        # Record the metadata of older uploads
+        # ====================================
+        if config.uploads.backfill.background:
+            spawn(uploads.backfill_metadata,
+                  batch_size=config.uploads.backfill.batch_size,
+                  pause=config.uploads.backfill.pause)
+
+        # ====================================
+        # Reap deleted files in the background
+        # ====================================
+        spawn(reaper.run,
+              batch_size=config.deletion.batch_size,
+              files_per_second=config.deletion.files_per_second,
+              undo_seconds=config.deletion.undo_seconds,
+              interval=config.deletion.interval)
+
         # =============================
         # Start server and print FIGlet
         # =============================
@@ -230,6 +290,17 @@ if __name__ == "__main__":
         
         quit()
 
+    # ================================================
+    # Move flat uploads to the sharded layout and exit
+    # ================================================
+    if "--migrate-uploads" in argv:
+        uploads.prepare()
+        uploads.migrate_layout(batch_size=config.uploads.migration.batch_size,
+                               pause=0)
+
+        quit()
+
     Imago().boot()
     WSGIServer((config.server.host, config.server.port), app, 
-               log=None).serve_forever()
\ No newline at end of file
+               log=None,
+               handler_class=SendfileHandler).serve_forever()
\ No newline at end of file
@@ -31,6 +31,16 @@ class File(blueprint):
         self.id = file_data.pop("id")
         self.key = file_data.pop("key")
         self.deleted = file_data.pop("deleted")
+        self.digest = file_data.pop("digest", None)
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # recorded at upload, these are None for older files
+        # until uploads.backfill_metadata has filled them in
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        self.size = file_data.pop("size", None)
+        self.mimetype = file_data.pop("mimetype", None)
+        self.width = file_data.pop("width", None)
+        self.height = file_data.pop("height", None)
 
         self.created_at = file_data.pop("created_at")
 
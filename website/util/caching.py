@@ -0,0 +1,86 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Optional, Tuple
+from util.blueprints import File
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from datetime import datetime
+from hashlib import sha256
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from flask import request, Response
+
+
+def validators(path: Optional[str] = None,
+               file: Optional[File] = None,
+               variant: Optional[str] = "",
+               stat: Optional[Any] = None) -> Tuple[str, datetime]:
+    """Returns a strong ETag and the Last-Modified time of a stored file.
+
+    Uploads never change once they have a key, so the ETag is the upload's content digest where it's known and its
+    mtime and size otherwise. variant tells apart different responses built from the same upload (e.g: a thumbnail
+    or a rendered page) and is hashed into the ETag.
+
+    Files that aren't on the local disk are described by stat (see util.storage.Stat) instead of path."""
+
+    stat = stat or os.stat(path)
+    etag = file.digest if file is not None and file.digest is not None else f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    if variant:
+        etag += "-" + sha256(variant.encode()).hexdigest()[:16]
+
+    return etag, datetime.utcfromtimestamp(int(stat.st_mtime))
+
+def is_fresh(etag: str,
+             last_modified: datetime) -> bool:
+    """Checks whether or not the client's cached copy is still current, going by its conditional request headers.
+
+    If-Modified-Since is only looked at when there's no If-None-Match, as the spec says."""
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+
+    if since is not None:
+        return last_modified <= since.replace(tzinfo=None)
+
+    return False
+
+def cacheable(response: Response,
+              etag: str,
+              last_modified: datetime,
+              max_age: int,
+              immutable: Optional[bool] = False) -> Response:
+    """Adds the validators and a public Cache-Control header to a response."""
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = f"public, max-age={max_age}" + (", immutable" if immutable else "")
+
+    return response
+
+def not_modified(etag: str,
+                 last_modified: datetime,
+                 max_age: int,
+                 immutable: Optional[bool] = False) -> Response:
+    """Returns an empty 304 response telling the client to use its cached copy."""
+
+    return cacheable(response=Response(status=304),
+                     etag=etag,
+                     last_modified=last_modified,
+                     max_age=max_age,
+                     immutable=immutable)
@@ -0,0 +1,139 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Brotli is optional: if the brotli package isn't installed, only gzip is offered.
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Iterable, List, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+import gzip
+import os
+
+from tempfile import mkstemp
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from flask import request, Response
+
+try:
+    import brotli
+
+except ImportError:
+    brotli = None
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+import util.utilities as utils
+
+from util.constants import config
+
+
+COMPRESSIBLE_TYPES = ("text", "code", "markdown")
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# content codings we can send, most preferred
+# first, as coding: sidecar file extension
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+ENCODINGS = {"br": "br", "gzip": "gz"} if brotli is not None else {"gzip": "gz"}
+
+
+def compressible(key: str) -> bool:
+    """Checks whether or not the upload with the given key is text that's worth compressing."""
+
+    return utils.filetype(filename=key) in COMPRESSIBLE_TYPES
+
+def negotiate(available: Optional[Iterable[str]] = None) -> Optional[str]:
+    """Returns the content coding the response to this request should use, or None if it should be sent as it is.
+
+    Only codings in available are considered (by default every coding in ENCODINGS, for responses compressed on the
+    fly). The one the client gives the highest quality value wins, and ties go to the order of ENCODINGS, so a client
+    that accepts both gets gzip whenever there's no Brotli copy."""
+
+    if not config.compression.enabled:
+        return None
+
+    available = ENCODINGS if available is None else set(available)
+    accepted = [encoding for encoding in ENCODINGS if encoding in available and request.accept_encodings[encoding] > 0]
+
+    return max(accepted,
+               key=lambda encoding: request.accept_encodings[encoding],
+               default=None)
+
+def compress(data: bytes,
+             encoding: str) -> bytes:
+    """Compresses data with a content coding."""
+
+    if encoding == "br":
+        return brotli.compress(data, quality=config.compression.brotli_quality)
+
+    return gzip.compress(data, compresslevel=config.compression.gzip_level)
+
+def sidecar(path: str,
+            encoding: str) -> str:
+    """Returns where the precompressed copy of a stored file is kept."""
+
+    return f"{path}.{ENCODINGS[encoding]}"
+
+def sidecars(path: str) -> List[str]:
+    """Returns the content codings a stored file has a precompressed copy in."""
+
+    return [encoding for encoding in ENCODINGS if os.path.exists(sidecar(path=path, encoding=encoding))]
+
+def precompress(path: str):
+    """Writes a precompressed copy of a file next to it for each content coding.
+
+    A copy is only kept if it's meaningfully smaller than the file, so a missing sidecar just means the file is sent as it is."""
+
+    with open(file=path, mode="rb") as file:
+        data = file.read()
+
+    for encoding in ENCODINGS:
+        compressed = compress(data=data,
+                              encoding=encoding)
+
+        if len(compressed) > len(data) * 0.9:
+            continue
+
+        descriptor, temp_path = mkstemp(prefix=".sidecar-",
+                                        dir=os.path.dirname(path))
+
+        with os.fdopen(descriptor, "wb") as temp:
+            temp.write(compressed)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, sidecar(path=path,
+                                      encoding=encoding))
+
+def remove_sidecars(path: str):
+    """Deletes every precompressed copy of a file."""
+
+    for encoding in ENCODINGS:
+        if os.path.exists(sidecar(path=path, encoding=encoding)):
+            os.remove(sidecar(path=path,
+                              encoding=encoding))
+
+def compress_response(response: Response,
+                      encoding: Optional[str]) -> Response:
+    """Compresses a response body in place if it's big enough to be worth it.
+
+    The response always varies on Accept-Encoding, since the same URL may be sent compressed or not."""
+
+    response.vary.add("Accept-Encoding")
+
+    if encoding is None or response.direct_passthrough or response.content_length is None or response.content_length < config.compression.min_bytes:
+        return response
+
+    response.set_data(compress(data=response.get_data(),
+                               encoding=encoding))
+    response.headers["Content-Encoding"] = encoding
+
+    return response
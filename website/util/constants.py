@@ -14,16 +14,16 @@ from datetime import datetime
 # ------------------------
 from attrdict import AttrDict
 from custos import version
-from mistune import create_markdown, escape, HTMLRenderer
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import html
+from mistune import create_markdown, HTMLRenderer
 from yaml import safe_load
 
 # ======================
 # Import local libraries
 # ======================
+from util import highlighting
 from util.blueprints import User
+from util.keys import hash_token
+from util.registry import BoundedRegistry, Registry
 
 
 config = AttrDict(safe_load(open(file="config.yml")))
@@ -34,13 +34,20 @@ const = AttrDict(dict(boot_dt=datetime.utcnow(),
 
                                      created_at=datetime.utcnow(),
 
-                                     token=config.superuser.token,
+                                     token=hash_token(token=config.superuser.token) if config.security.hash_tokens else config.superuser.token,
                                      admin=True,
                                      id=0)))
 
-cache = AttrDict({"users": [const.superuser],
-                  "files": [],
-                  "urls": []})
+if config.cache.bounded:
+    cache = BoundedRegistry(superuser=const.superuser,
+                            max_files=config.cache.max_files,
+                            max_urls=config.cache.max_urls,
+                            page_size=config.cache.page_size,
+                            hash_tokens=config.security.hash_tokens)
+
+else:
+    cache = Registry(superuser=const.superuser,
+                     hash_tokens=config.security.hash_tokens)
 
 epoch = datetime(year=2000,
                  month=1,
@@ -55,21 +62,24 @@ version = version(major=4,
                   release="stable")
 
 app = None
+objects = None
+pages = None
 postgres = None
+storage = None
+thumbnails = None
+variants = None
+workers = None
+writer = None
 
 
 class HighlightRenderer(HTMLRenderer):
     def block_code(self, 
                    code: str, 
                    lang=None):
-        if lang:
-            lexer = get_lexer_by_name(lang, stripall=True)
-            formatter = html.HtmlFormatter(linenos=True, 
-                                           full=True,
-                                           style=config.code_style)
-            return highlight(code, lexer, formatter)
-
-        return "<pre><code>" + escape(code) + "</code></pre>"
+        return highlighting.highlight(code=code,
+                                      lang=lang,
+                                      style=config.code_style,
+                                      max_bytes=config.highlighting.max_bytes)
 
 markdown = create_markdown(renderer=HighlightRenderer(),
                            plugins=["strikethrough", "footnotes", "table", "url"])
\ No newline at end of file
@@ -0,0 +1,261 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Iterator, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent.lock import BoundedSemaphore
+from gevent.socket import wait_read, wait_write
+from psycopg2 import connect, extensions, InterfaceError, OperationalError
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console
+
+
+def gevent_wait_callback(connection: Any,
+                         timeout: Optional[float] = None):
+    """Waits for a psycopg2 connection to become ready by yielding to the gevent hub instead of blocking on the socket.
+
+    Once this is installed with extensions.set_wait_callback, every query made by any connection lets other greenlets run while it waits on Postgres."""
+
+    while True:
+        state = connection.poll()
+
+        if state == extensions.POLL_OK:
+            break
+
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(),
+                      timeout=timeout)
+
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(),
+                       timeout=timeout)
+
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+class PoolTimeout(Exception):
+    """Raised when a connection couldn't be checked out of the pool in time."""
+
+
+class Pool:
+    """This is a pool of autocommit Postgres connections that can be shared between greenlets.
+
+    Between min_size and max_size connections are kept open. Connections that have sat idle for longer than the health check
+    interval are pinged before they're handed out, and broken connections are thrown away and replaced.
+
+    The pool keeps track of how long greenlets wait to check out a connection, see stats."""
+
+    def __init__(self,
+                 dsn: str,
+                 min_size: Optional[int] = 1,
+                 max_size: Optional[int] = 10,
+                 health_check_interval: Optional[float] = 30,
+                 acquire_timeout: Optional[float] = 10):
+        self.dsn = dsn
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # the semaphore caps how many connections can be checked
+        # out, idle holds (connection, last used) pairs
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        self._slots = BoundedSemaphore(value=max_size)
+        self._idle = []
+        self._open = 0
+
+        # =======
+        # Metrics
+        # =======
+        self.checkouts = 0
+        self.reconnects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        extensions.set_wait_callback(gevent_wait_callback)
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), monotonic()))
+
+    def _connect(self) -> Any:
+        """Opens a new autocommit connection."""
+
+        connection = connect(dsn=self.dsn)
+        connection.autocommit = True
+
+        self._open += 1
+
+        return connection
+
+    def _discard(self,
+                 connection: Any):
+        """Closes a connection and forgets about it."""
+
+        self._open -= 1
+
+        try:
+            connection.close()
+
+        except Exception:
+            pass
+
+    def _healthy(self,
+                 connection: Any,
+                 last_used: float) -> bool:
+        """Checks whether or not an idle connection can still be used."""
+
+        if connection.closed:
+            return False
+
+        if monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with connection.cursor() as con:
+                con.execute("SELECT 1;")
+
+            return True
+
+        except (InterfaceError, OperationalError):
+            return False
+
+    def acquire(self) -> Any:
+        """Checks a connection out of the pool, waiting for one to be released if every connection is in use."""
+
+        started = perf_counter()
+
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PoolTimeout(f"No Postgres connection became free within {self.acquire_timeout}s.")
+
+        waited = perf_counter() - started
+
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        try:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+
+                if self._healthy(connection=connection,
+                                 last_used=last_used):
+                    return connection
+
+                console.warn(text="Dropping broken Postgres connection, reconnecting.")
+                self.reconnects += 1
+                self._discard(connection=connection)
+
+            return self._connect()
+
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self,
+                connection: Any,
+                broken: Optional[bool] = False):
+        """Puts a connection back into the pool, or throws it away if it's broken."""
+
+        try:
+            if broken or connection.closed or connection.status != extensions.STATUS_READY:
+                self._discard(connection=connection)
+
+            else:
+                self._idle.append((connection, monotonic()))
+
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Checks out a connection for the duration of a with block."""
+
+        connection = self.acquire()
+        broken = False
+
+        try:
+            yield connection
+
+        except (InterfaceError, OperationalError):
+            broken = True
+            raise
+
+        finally:
+            self.release(connection=connection,
+                         broken=broken)
+
+    @contextmanager
+    def cursor(self,
+               **options: dict) -> Iterator[Any]:
+        """Checks out a connection and opens a cursor on it for the duration of a with block.
+
+        This is a drop-in replacement for connection.cursor(), so existing with postgres.cursor() blocks keep working."""
+
+        with self.connection() as connection:
+            with connection.cursor(**options) as con:
+                yield con
+
+    @contextmanager
+    def transaction(self) -> Iterator[Any]:
+        """Checks out a connection and opens a cursor inside a transaction for the duration of a with block.
+
+        The transaction is committed when the block exits normally and rolled back if it raises, so row locks taken
+        with SELECT ... FOR UPDATE are held until the block is done."""
+
+        with self.connection() as connection:
+            connection.autocommit = False
+
+            try:
+                with connection.cursor() as con:
+                    yield con
+
+                connection.commit()
+
+            except BaseException:
+                connection.rollback()
+                raise
+
+            finally:
+                connection.autocommit = True
+
+    @property
+    def stats(self) -> dict:
+        """Returns the pool's size and wait-time metrics."""
+
+        return dict(open=self._open,
+                    idle=len(self._idle),
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    checkouts=self.checkouts,
+                    reconnects=self.reconnects,
+                    wait_total=round(self.wait_total, 6),
+                    wait_average=round(self.wait_total / self.checkouts, 6) if self.checkouts else 0.0,
+                    wait_max=round(self.wait_max, 6))
+
+    def close(self):
+        """Closes every idle connection."""
+
+        while self._idle:
+            connection, _ = self._idle.pop()
+            self._discard(connection=connection)
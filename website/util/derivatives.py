@@ -0,0 +1,376 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Callable, Iterable, Mapping, Optional, Tuple, Union
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from collections import defaultdict, OrderedDict
+from tempfile import mkstemp
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import spawn
+from gevent.event import AsyncResult
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+import util.utilities as utils
+
+from util import console, constants, tasks, uploads
+from util.constants import config
+
+
+THUMBNAIL_DIR = "data/derivatives/thumbnails"
+THUMBNAIL_TYPES = ("image", "gif")
+
+VARIANT_DIR = "data/derivatives/variants"
+VARIANT_FITS = ("contain", "cover")
+VARIANT_PARAMETERS = ("w", "h", "fit", "q")
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# formats images can be transcoded to, most preferred first,
+# as mimetype: (Pillow format, extension). AVIF is only
+# offered if this build of Pillow can encode it
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Image.init()
+
+TRANSCODABLE = ("png", "jpg", "jpeg")
+TRANSCODE_FORMATS = {mimetype: (image_format, extension) for mimetype, image_format, extension in (("image/avif", "AVIF", "avif"),
+                                                                                                  ("image/webp", "WEBP", "webp"))
+                     if image_format in Image.SAVE}
+
+
+class DerivativeCache:
+    """This is an on-disk cache of files derived from uploads, such as thumbnails, bounded by total size.
+
+    Every entry is named after the key of the upload it was derived from, followed by an @ and whatever describes
+    the derivative (e.g: thumbnail.jpg). Entries are tracked in LRU order, and once the cache grows past max_bytes
+    the least recently used entries are deleted.
+
+    get_or_create makes sure a missing entry is only ever built once, however many requests ask for it at the same time."""
+
+    def __init__(self,
+                 directory: str,
+                 max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._building = {}
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # entry names by the key they were derived from, so
+        # removing an upload's entries doesn't scan them all
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        self._keys = defaultdict(set)
+
+        # =======
+        # Metrics
+        # =======
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory,
+                    exist_ok=True)
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # pick up entries left over from the last run, treating the
+        # most recently modified ones as the most recently used
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        existing = []
+
+        for entry in os.scandir(directory):
+            if entry.name.startswith("."):
+                os.remove(entry.path)
+                continue
+
+            stat = entry.stat()
+            existing.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self._keys[name.split("@", 1)[0]].add(name)
+            self._size += size
+
+        self._evict()
+
+    def path(self,
+             name: str) -> str:
+        """Returns where an entry is stored."""
+
+        return f"{self.directory}/{name}"
+
+    def get(self,
+            name: str) -> Optional[str]:
+        """Returns the path of an entry and marks it as recently used, or None if it isn't cached."""
+
+        if name not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(name)
+
+        return self.path(name=name)
+
+    def put(self,
+            name: str,
+            data: Union[bytes, Iterable[bytes]]) -> str:
+        """Atomically writes an entry and returns its path, evicting old entries if the cache is over budget.
+
+        data is either the whole entry or an iterable of chunks of it, which are written as they come in."""
+
+        descriptor, temp_path = mkstemp(prefix=".derivative-",
+                                        dir=self.directory)
+
+        try:
+            with os.fdopen(descriptor, "wb") as temp:
+                for chunk in ([data] if isinstance(data, bytes) else data):
+                    temp.write(chunk)
+
+                size = temp.tell()
+
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.path(name=name))
+
+        self._size += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+        self._keys[name.split("@", 1)[0]].add(name)
+
+        self._evict()
+
+        return self.path(name=name)
+
+    def get_or_create(self,
+                      name: str,
+                      build: Callable[[], Union[bytes, Iterable[bytes]]]) -> str:
+        """Returns the path of an entry, building and storing it first if it isn't cached.
+
+        If the entry is already being built for another request, this waits for that build instead of starting another."""
+
+        path = self.get(name=name)
+
+        if path is not None:
+            return path
+
+        if name in self._building:
+            return self._building[name].get()
+
+        result = self._building[name] = AsyncResult()
+
+        try:
+            path = self.put(name=name,
+                            data=build())
+            result.set(path)
+
+            return path
+
+        except Exception as error:
+            result.set_exception(error)
+            raise
+
+        finally:
+            del self._building[name]
+
+    def _evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+
+        while self._size > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+            self._unindex(name=name)
+
+            if os.path.exists(self.path(name=name)):
+                os.remove(self.path(name=name))
+
+    def _unindex(self,
+                 name: str):
+        """Drops an entry from the by-key index."""
+
+        key = name.split("@", 1)[0]
+        names = self._keys.get(key)
+
+        if names is not None:
+            names.discard(name)
+
+            if not names:
+                del self._keys[key]
+
+    def remove(self,
+               key: str):
+        """Deletes every entry derived from the upload with the given key."""
+
+        for name in self._keys.pop(key, ()):
+            self._size -= self._entries.pop(name, 0)
+
+            if os.path.exists(self.path(name=name)):
+                os.remove(self.path(name=name))
+
+    @property
+    def stats(self) -> dict:
+        """Returns the cache's size and hit rate."""
+
+        return dict(entries=len(self._entries),
+                    bytes=self._size,
+                    max_bytes=self.max_bytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+
+def source(key: str) -> str:
+    """Returns where the upload a derivative is made from is stored, raising FileNotFoundError if it no longer exists."""
+
+    path = uploads.fetch(key=key)
+
+    if path is None:
+        raise FileNotFoundError(key)
+
+    return path
+
+def thumbnailable(key: str) -> bool:
+    """Checks whether or not a thumbnail can be made of the upload with the given key."""
+
+    return utils.filetype(filename=key) in THUMBNAIL_TYPES
+
+def thumbnail(key: str) -> str:
+    """Returns the path of an upload's thumbnail, making it in a worker process first if it isn't cached.
+
+    Raises OSError if the upload can't be decoded as an image."""
+
+    return constants.thumbnails.get_or_create(name=f"{key}@thumbnail.jpg",
+                                              build=lambda: constants.workers.run(tasks.make_thumbnail, source(key=key)))
+
+def warm_thumbnail(key: str):
+    """Makes an upload's thumbnail in the background, so it's ready before anyone asks for it."""
+
+    def make():
+        try:
+            thumbnail(key=key)
+
+        except Exception as error:
+            console.warn(text=f"Failed to make a thumbnail of {key}.\n\n{error}")
+
+    spawn(make)
+
+def variant_options(args: Mapping[str, str]) -> dict:
+    """Reads the size, fit and quality of an image variant from a request's query string.
+
+    Widths, heights and qualities are limited to the allowed lists in the configuration, so the number of variants that can
+    be made of each upload stays small. Raises ValueError describing the first invalid parameter."""
+
+    local_config = config.variants
+    options = dict(width=0,
+                   height=0,
+                   fit=args.get("fit", "contain"),
+                   quality=local_config.default_quality)
+
+    for name, parameter, allowed in (("width", "w", local_config.widths),
+                                     ("height", "h", local_config.heights),
+                                     ("quality", "q", local_config.qualities)):
+        if parameter not in args:
+            continue
+
+        try:
+            options[name] = int(args[parameter])
+
+        except ValueError:
+            raise ValueError(f"{parameter} must be a number.")
+
+        if options[name] not in allowed:
+            raise ValueError(f"{parameter} must be one of: {', '.join(map(str, allowed))}.")
+
+    if not (options["width"] or options["height"]):
+        raise ValueError("At least one of w or h is required.")
+
+    if options["fit"] not in VARIANT_FITS:
+        raise ValueError(f"fit must be one of: {', '.join(VARIANT_FITS)}.")
+
+    return options
+
+def variant(key: str,
+            width: int,
+            height: int,
+            fit: str,
+            quality: int) -> str:
+    """Returns the path of a resized copy of an upload, making it in a worker process first if it isn't cached.
+
+    Raises OSError if the upload can't be decoded as an image."""
+
+    return constants.variants.get_or_create(name=f"{key}@{width}x{height}-{fit}-q{quality}.{utils.filext(filename=key)}",
+                                            build=lambda: constants.workers.run(tasks.resize_image, source(key=key), width, height, fit, quality))
+
+def transcodable(key: str) -> bool:
+    """Checks whether or not the upload with the given key can be sent in another image format."""
+
+    return utils.filext(filename=key) in TRANSCODABLE
+
+def negotiate(key: str,
+              accept: MIMEAccept) -> Optional[str]:
+    """Returns the mimetype of the smaller format an image should be sent in, or None if it should be sent as it is.
+
+    Only formats the client names outright are picked, so a catch-all like */* never gets an AVIF it might not understand."""
+
+    if not config.negotiation.enabled or not transcodable(key=key):
+        return None
+
+    for mimetype in TRANSCODE_FORMATS:
+        if any(value == mimetype and quality > 0 for value, quality in accept):
+            return mimetype
+
+    return None
+
+def transcode(name: str,
+              source: str,
+              mimetype: str) -> Tuple[str, str]:
+    """Returns the path and mimetype to send for an image in the given format, transcoding it in a worker process first if it isn't cached.
+
+    name identifies the image being transcoded and must start with the key of its upload (e.g: {key}@original), so the
+    transcoded copy is deleted along with it. If the transcoded copy turns out no smaller, the source is sent instead."""
+
+    image_format, extension = TRANSCODE_FORMATS[mimetype]
+
+    path = constants.variants.get_or_create(name=f"{name}.{extension}",
+                                            build=lambda: constants.workers.run(tasks.transcode_image, source, image_format, config.negotiation.quality))
+
+    if os.path.getsize(path) >= os.path.getsize(source):
+        return source, None
+
+    return path, mimetype
+
+def warm_transcodes(key: str):
+    """Transcodes an upload to every supported format in the background, so they're ready before anyone asks for them."""
+
+    def make():
+        for mimetype in TRANSCODE_FORMATS:
+            try:
+                transcode(name=f"{key}@original",
+                          source=source(key=key),
+                          mimetype=mimetype)
+
+            except Exception as error:
+                console.warn(text=f"Failed to transcode {key} to {mimetype}.\n\n{error}")
+
+    spawn(make)
@@ -0,0 +1,100 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Lexers, formatters and stylesheets are built once and reused, since building them
+# is a large share of the cost of highlighting a small snippet. Highlighted code only
+# carries CSS classes; the colours come from the stylesheet, which is served once
+# at /highlight.css instead of being inlined into every page.
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+from functools import lru_cache
+from hashlib import sha256
+from html import escape
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from pygments import highlight as pygments_highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+from pygments.util import ClassNotFound
+
+
+CSS_CLASS = "highlight"
+
+
+@lru_cache(maxsize=None)
+def lexer(lang: str) -> Optional[Lexer]:
+    """Returns the lexer for a language name or alias (e.g: python, rs), or None if pygments doesn't know it.
+
+    Leading and trailing blank lines are kept, so line numbers match the file."""
+
+    try:
+        return get_lexer_by_name(lang, stripnl=False)
+
+    except ClassNotFound:
+        return None
+
+@lru_cache(maxsize=None)
+def language(extension: str) -> Optional[str]:
+    """Returns the name of the language a file extension belongs to (e.g: rs gives rust), or None if pygments doesn't know it."""
+
+    try:
+        return get_lexer_for_filename(f"file.{extension}").aliases[0]
+
+    except ClassNotFound:
+        return None
+
+@lru_cache(maxsize=256)
+def formatter(style: str,
+              first_line: Optional[int] = 1) -> HtmlFormatter:
+    """Returns the HTML formatter for a pygments style, numbering lines from first_line."""
+
+    return HtmlFormatter(linenos=True,
+                         linenostart=first_line,
+                         cssclass=CSS_CLASS,
+                         style=style)
+
+@lru_cache(maxsize=None)
+def stylesheet(style: str) -> str:
+    """Returns the CSS that colours highlighted code in a pygments style."""
+
+    return formatter(style=style).get_style_defs(f".{CSS_CLASS}")
+
+@lru_cache(maxsize=None)
+def stylesheet_version(style: str) -> str:
+    """Returns a short hash of a style's CSS, which changes whenever the stylesheet does."""
+
+    return sha256(stylesheet(style=style).encode()).hexdigest()[:16]
+
+def plain(code: str) -> str:
+    """Returns code as escaped, unhighlighted HTML."""
+
+    return "<pre><code>" + escape(code) + "</code></pre>"
+
+def highlight(code: str,
+              lang: Optional[str],
+              style: str,
+              max_bytes: int,
+              first_line: Optional[int] = 1) -> str:
+    """Returns code highlighted as HTML, with lines numbered from first_line.
+
+    Code longer than max_bytes, or in a language pygments doesn't know, comes back plain instead."""
+
+    code_lexer = lexer(lang=lang) if lang else None
+
+    if code_lexer is None or len(code) > max_bytes:
+        return plain(code=code)
+
+    return pygments_highlight(code, code_lexer, formatter(style=style,
+                                                          first_line=first_line))
@@ -0,0 +1,109 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Callable, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+from collections import deque
+from hashlib import sha256
+from secrets import choice
+from string import ascii_letters, digits
+
+
+ALPHABET = ascii_letters + digits
+
+
+class KeyAllocator:
+    """This hands out random keys that aren't taken yet.
+
+    Candidates are generated in batches of pool_size ahead of time and every collision check is a single call to taken,
+    which is expected to be a set or dict membership test.
+
+    The fraction of candidates that turn out to be taken is a running estimate of how full the key space is. Once it passes
+    grow_at, the key length is increased by one so allocation never degrades into a long retry loop.
+
+    Keys are only unique within this process, so callers must still rely on a unique constraint (and call collided when it
+    fires) when several worker processes share a database."""
+
+    def __init__(self,
+                 length: int,
+                 taken: Callable[[str], bool],
+                 pool_size: Optional[int] = 256,
+                 grow_at: Optional[float] = 0.5,
+                 occupied: Optional[int] = 0):
+        self.length = length
+        self.taken = taken
+
+        self.pool_size = pool_size
+        self.grow_at = grow_at
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # if we already know how many keys exist, start at a length
+        # that is comfortably below the growth threshold
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        while occupied / len(ALPHABET) ** self.length > self.grow_at:
+            self.length += 1
+
+        self.occupancy = occupied / len(ALPHABET) ** self.length
+
+        self._pool = deque()
+
+    def _refill(self):
+        """Generates a fresh batch of candidate keys at the current length."""
+
+        self._pool.clear()
+        self._pool.extend("".join(choice(ALPHABET) for _ in range(self.length)) for _ in range(self.pool_size))
+
+    def _observe(self,
+                 collided: bool):
+        """Updates the occupancy estimate with the outcome of one candidate, growing the key length if it passes grow_at."""
+
+        self.occupancy += ((1.0 if collided else 0.0) - self.occupancy) / 64
+
+        if self.occupancy > self.grow_at:
+            self.length += 1
+            self.occupancy /= len(ALPHABET)
+
+            self._pool.clear()
+
+    def allocate(self,
+                 suffix: Optional[str] = "") -> str:
+        """Returns an available key, with an optional suffix (e.g: a file extension) appended to it."""
+
+        while True:
+            if not self._pool:
+                self._refill()
+
+            key = self._pool.popleft() + suffix
+            collided = self.taken(key)
+
+            self._observe(collided=collided)
+
+            if not collided:
+                return key
+
+    def collided(self):
+        """Records that a key returned by allocate was taken elsewhere, e.g: by another worker process."""
+
+        self._observe(collided=True)
+
+
+def hash_token(token: str) -> str:
+    """Returns the form an API token is stored in when config.security.hash_tokens is enabled.
+
+    Tokens are long and random, so a single unsalted SHA-256 is enough and keeps authentication to one hash and one dict lookup."""
+
+    return "sha256$" + sha256(token.encode()).hexdigest()
+
+def is_hashed(token: str) -> bool:
+    """Checks whether or not a stored token has already been hashed."""
+
+    return token.startswith("sha256$")
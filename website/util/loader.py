@@ -0,0 +1,165 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+# -----------------
+# Builtin libraries
+# -----------------
+from time import perf_counter
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console
+from util.constants import config
+from util.keys import hash_token, is_hashed
+from util.registry import FILE_COLUMNS, Registry, URL_COLUMNS, USER_COLUMNS
+
+
+QUERIES = {
+    "users": f"""SELECT {USER_COLUMNS}
+                 FROM users
+                 ORDER BY id ASC;""",
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # files and URLs are loaded oldest first because the
+    # registry treats the last item added as the newest
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    "files": f"""SELECT {FILE_COLUMNS}
+                 FROM files
+                 ORDER BY created_at ASC;""",
+
+    "urls": f"""SELECT {URL_COLUMNS}
+                FROM urls
+                ORDER BY created_at ASC;"""
+}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# a bounded registry is only warmed with the newest rows that
+# fit in it, which are still handed over oldest first
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+BOUNDED_QUERIES = {
+    "files": f"""SELECT {FILE_COLUMNS}
+                 FROM (SELECT {FILE_COLUMNS}
+                       FROM files
+                       ORDER BY created_at DESC
+                       LIMIT %(limit)s) AS recent
+                 ORDER BY created_at ASC;""",
+
+    "urls": f"""SELECT {URL_COLUMNS}
+                FROM (SELECT {URL_COLUMNS}
+                      FROM urls
+                      ORDER BY created_at DESC
+                      LIMIT %(limit)s) AS recent
+                ORDER BY created_at ASC;"""
+}
+
+
+def stream(connection: Any,
+           table: str,
+           limit: Optional[int] = None) -> Iterator[Tuple]:
+    """Yields every row of a table through a named, server-side cursor.
+
+    Rows are pulled from Postgres in batches of config.loader.fetch_size, so the full result set is never held in memory at once.
+    If a limit is given, only that many of the newest rows are yielded."""
+
+    with connection.cursor(name=f"imago_populate_{table}") as con:
+        con.itersize = config.loader.fetch_size
+
+        if limit is None:
+            con.execute(QUERIES[table])
+
+        else:
+            con.execute(BOUNDED_QUERIES[table],
+                        dict(limit=limit))
+
+        yield from con
+
+def populate_table(connection: Any,
+                   table: str,
+                   build: Callable,
+                   limit: Optional[int] = None):
+    """Streams a table into the registry with build, logging a progress summary every config.loader.progress_every rows."""
+
+    every = config.loader.progress_every
+    started = perf_counter()
+    count = 0
+
+    console.verbose(text=f"Populating {table} cache...")
+
+    for row in stream(connection=connection,
+                      table=table,
+                      limit=limit):
+        build(row)
+        count += 1
+
+        if every and count % every == 0:
+            console.verbose(text=f"Populated {count} {table} so far ({round(perf_counter() - started, 2)}s).")
+
+    console.info(text=f"Populated {count} {table} in {round(perf_counter() - started, 2)}s.")
+
+    return count
+
+def hash_stored_tokens(connection: Any,
+                       registry: Registry):
+    """Replaces any raw API tokens left in the users table with their hashes.
+
+    This runs once when config.security.hash_tokens is first enabled, after which every stored token is already hashed."""
+
+    raw = [user for user in registry.users if user.id != registry.superuser.id and not is_hashed(token=user.token)]
+
+    if not raw:
+        return
+
+    with connection.cursor() as con:
+        for user in raw:
+            hashed = hash_token(token=user.token)
+
+            con.execute("""UPDATE users
+                           SET token = %(token)s
+                           WHERE id = %(id)s;""",
+                        dict(token=hashed,
+                             id=user.id))
+
+            registry.update_user(user=user,
+                                 token=hashed)
+
+    console.info(text=f"Hashed the stored API tokens of {len(raw)} users.")
+
+def populate(connection: Any,
+             registry: Registry):
+    """Loads every user, file and URL into the registry.
+
+    Named cursors have to live inside a transaction, so this must be called before the connection is switched to autocommit.
+    Owners are resolved through the registry's ID index rather than by searching the user list.
+    A bounded registry only receives as many of the newest files and URLs as it can hold."""
+
+    started = perf_counter()
+
+    populate_table(connection=connection,
+                   table="users",
+                   build=lambda row: registry.add_user(user=registry.make_user(row=row)))
+
+    if registry.hash_tokens:
+        hash_stored_tokens(connection=connection,
+                           registry=registry)
+
+    populate_table(connection=connection,
+                   table="files",
+                   build=lambda row: registry.add_file(file=registry.make_file(row=row)),
+                   limit=registry.max_files if registry.bounded else None)
+
+    populate_table(connection=connection,
+                   table="urls",
+                   build=lambda row: registry.add_url(url=registry.make_url(row=row)),
+                   limit=registry.max_urls if registry.bounded else None)
+
+    connection.commit()
+    console.info(text=f"Cache population finished in {round(perf_counter() - started, 2)}s.")
@@ -0,0 +1,148 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Optional
+from util.derivatives import DerivativeCache
+
+# -----------------
+# Builtin libraries
+# -----------------
+from collections import OrderedDict
+
+
+PAGE_DIR = "data/derivatives/pages"
+
+
+class PageCache:
+    """This keeps the rendered HTML of text, code and markdown pages in memory, bounded by total size.
+
+    Each page is stored under its upload's key along with a stamp (the upload's mtime and the release it was rendered by),
+    so a page rendered from an older copy or by an older release is never served. Pages are evicted least recently used
+    first once they take up more than max_bytes.
+
+    If a DerivativeCache is given as store, pages are also written to disk there, so they survive restarts."""
+
+    def __init__(self,
+                 max_bytes: int,
+                 store: Optional[DerivativeCache] = None):
+        self.max_bytes = max_bytes
+        self.store = store
+
+        self._pages = OrderedDict()
+        self._size = 0
+
+        # =======
+        # Metrics
+        # =======
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self,
+                  key: str,
+                  stamp: str,
+                  page: str,
+                  size: int):
+        """Stores a page of size encoded bytes in memory, evicting the least recently used pages if the cache is over budget."""
+
+        self._forget(key=key)
+
+        self._pages[key] = (stamp, page, size)
+        self._size += size
+
+        while self._size > self.max_bytes and self._pages:
+            _, (_, _, evicted) = self._pages.popitem(last=False)
+            self._size -= evicted
+            self.evictions += 1
+
+    def _forget(self,
+                key: str):
+        """Drops a page from memory, if it's there."""
+
+        cached = self._pages.pop(key, None)
+
+        if cached is not None:
+            self._size -= cached[2]
+
+    def get(self,
+            key: str,
+            stamp: str) -> Optional[str]:
+        """Returns the rendered page of an upload, or None if it hasn't been rendered with this stamp."""
+
+        cached = self._pages.get(key)
+
+        if cached is not None and cached[0] == stamp:
+            self.hits += 1
+            self._pages.move_to_end(key)
+
+            return cached[1]
+
+        if self.store is not None:
+            path = self.store.get(name=f"{key}@page-{stamp}.html")
+
+            if path is not None:
+                with open(file=path, mode="rb") as file:
+                    data = file.read()
+
+                page = data.decode("utf-8")
+
+                self.disk_hits += 1
+                self._remember(key=key,
+                               stamp=stamp,
+                               page=page,
+                               size=len(data))
+
+                return page
+
+        self.misses += 1
+
+        return None
+
+    def put(self,
+            key: str,
+            stamp: str,
+            page: str):
+        """Stores the rendered page of an upload.
+
+        Pages are budgeted by their size encoded as UTF-8, which is what they take up on disk and on the wire."""
+
+        data = page.encode("utf-8")
+
+        self._remember(key=key,
+                       stamp=stamp,
+                       page=page,
+                       size=len(data))
+
+        if self.store is not None:
+            self.store.remove(key=key)
+            self.store.put(name=f"{key}@page-{stamp}.html",
+                           data=data)
+
+    def remove(self,
+               key: str):
+        """Drops the rendered page of an upload, e.g: when it's deleted."""
+
+        self._forget(key=key)
+
+        if self.store is not None:
+            self.store.remove(key=key)
+
+    @property
+    def stats(self) -> dict:
+        """Returns the cache's size and hit rate."""
+
+        return dict(entries=len(self._pages),
+                    bytes=self._size,
+                    max_bytes=self.max_bytes,
+                    hits=self.hits,
+                    disk_hits=self.disk_hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    disk=self.store.stats if self.store is not None else None)
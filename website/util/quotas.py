@@ -0,0 +1,135 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Optional, Tuple
+from util.blueprints import User
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console, constants
+from util.constants import config
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# how much each user has stored, as owner ID: [bytes,
+# files], mirroring the usage table in Postgres
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+usage = {}
+
+
+def populate(connection: Any):
+    """Loads every user's usage counters.
+
+    The usage table is seeded from the files table the first time it's created, which is the only time usage is ever
+    summed up: from then on the counters are adjusted as files are uploaded and deleted."""
+
+    with connection.cursor() as con:
+        con.execute("""SELECT EXISTS (SELECT 1 FROM usage);""")
+
+        if not con.fetchone()[0]:
+            con.execute("""INSERT INTO usage (owner_id, bytes, files)
+                           SELECT owner_id, COALESCE(SUM(size), 0), COUNT(*)
+                           FROM files
+                           WHERE deleted IS NOT TRUE
+                           GROUP BY owner_id
+
+                           ON CONFLICT (owner_id) DO NOTHING;""")
+
+        con.execute("""SELECT owner_id, bytes, files
+                       FROM usage;""")
+
+        for owner_id, stored_bytes, files in con.fetchall():
+            usage[owner_id] = [stored_bytes, files]
+
+    connection.commit()
+    console.info(text=f"Loaded the storage usage of {len(usage)} users.")
+
+def usage_of(user: User) -> Tuple[int, int]:
+    """Returns how many bytes and files a user has stored."""
+
+    stored_bytes, files = usage.get(user.id, (0, 0))
+
+    return stored_bytes, files
+
+def limits_of(user: User) -> Tuple[Optional[int], Optional[int]]:
+    """Returns the most bytes and files a user may store, where None means there's no limit."""
+
+    if not config.quotas.enabled or (user.admin and config.quotas.admins_exempt):
+        return None, None
+
+    max_bytes = config.quotas.max_megabytes * 1024**2 if config.quotas.max_megabytes is not None else None
+
+    return max_bytes, config.quotas.max_files
+
+def allows(user: User,
+           size: Optional[int] = 0) -> bool:
+    """Checks whether or not a user has room for another file of the given size, going by the in-memory counters.
+
+    This is only a quick early check, reserve is what actually enforces the quota."""
+
+    max_bytes, max_files = limits_of(user=user)
+    stored_bytes, files = usage_of(user=user)
+
+    return (max_bytes is None or stored_bytes + size <= max_bytes) and (max_files is None or files < max_files)
+
+def reserve(user: User,
+            size: int) -> bool:
+    """Counts a new file of the given size against a user's quota, returning False if it doesn't fit.
+
+    The check and the increment are one statement, so concurrent uploads (even in other worker processes) can never
+    take a user past their quota together. The in-memory counters are refreshed from the row it returns."""
+
+    max_bytes, max_files = limits_of(user=user)
+
+    if (max_bytes is not None and size > max_bytes) or max_files == 0:
+        return False
+
+    with constants.postgres.cursor() as con:
+        con.execute("""INSERT INTO usage (owner_id, bytes, files)
+                       VALUES (%(owner_id)s, %(size)s, 1)
+
+                       ON CONFLICT (owner_id) DO UPDATE
+                       SET bytes = usage.bytes + excluded.bytes, files = usage.files + 1
+                       WHERE (%(max_bytes)s::BIGINT IS NULL OR usage.bytes + excluded.bytes <= %(max_bytes)s)
+                         AND (%(max_files)s::INT IS NULL OR usage.files + 1 <= %(max_files)s)
+
+                       RETURNING bytes, files;""",
+                    dict(owner_id=user.id,
+                         size=size,
+                         max_bytes=max_bytes,
+                         max_files=max_files))
+
+        row = con.fetchone()
+
+    if row is None:
+        return False
+
+    usage[user.id] = list(row)
+
+    return True
+
+def adjust(owner_id: int,
+           size: int,
+           files: Optional[int] = 0):
+    """Adds to (or, with negative numbers, takes from) a user's counters, e.g: when a file is deleted."""
+
+    with constants.postgres.cursor() as con:
+        con.execute("""INSERT INTO usage (owner_id, bytes, files)
+                       VALUES (%(owner_id)s, GREATEST(%(size)s, 0), GREATEST(%(files)s, 0))
+
+                       ON CONFLICT (owner_id) DO UPDATE
+                       SET bytes = GREATEST(usage.bytes + %(size)s, 0), files = GREATEST(usage.files + %(files)s, 0)
+
+                       RETURNING bytes, files;""",
+                    dict(owner_id=owner_id,
+                         size=size,
+                         files=files))
+
+        usage[owner_id] = list(con.fetchone())
@@ -0,0 +1,162 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Deleting a file only flags its row, so it can be restored for config.deletion.undo_seconds.
+# Once that window has passed, the reaper removes the row, the upload and its derivatives in
+# the background, so requests never wait on the disk or the storage backend.
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+from datetime import datetime, timedelta
+from time import monotonic
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import sleep
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console, constants, uploads
+from util.constants import cache
+from util.registry import FILE_COLUMNS
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# files that failed to be reaped, as ID: [failures, when
+# to try again], which are left out of batches until then
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+failures = {}
+
+
+def reap(batch_size: Optional[int] = 100,
+         files_per_second: Optional[float] = 50,
+         undo_seconds: Optional[int] = 300) -> int:
+    """Removes one batch of files that were deleted more than undo_seconds ago, returning how many were removed.
+
+    Each file's row is locked with SKIP LOCKED, so every worker process can reap at the same time without two of them
+    ever removing the same file, and a restore racing the reaper either wins or finds the row gone. The row and the
+    blob's reference are deleted together and committed before anything is removed from storage, so a failure can
+    only ever leave unreferenced bytes behind (which collect_orphans picks up), never a row without its contents.
+
+    A file that fails is left out of the following batches for a while, backing off each time it fails again, so it
+    can't hold up the rest of the queue. Files are removed at no more than files_per_second, so a mass delete doesn't
+    starve requests of I/O."""
+
+    cutoff = datetime.utcnow() - timedelta(seconds=undo_seconds)
+    now = monotonic()
+    skipped = [file_id for file_id, (_, retry_at) in failures.items() if retry_at > now]
+
+    with constants.postgres.cursor() as con:
+        con.execute("""SELECT id
+                       FROM files
+                       WHERE deleted AND deleted_at <= %(cutoff)s AND NOT (id = ANY(%(skipped)s))
+
+                       ORDER BY deleted_at
+                       LIMIT %(limit)s;""",
+                    dict(cutoff=cutoff,
+                         skipped=skipped,
+                         limit=batch_size))
+
+        ids = [row[0] for row in con.fetchall()]
+
+    reaped = 0
+
+    for file_id in ids:
+        try:
+            with constants.postgres.transaction() as con:
+                con.execute(f"""SELECT {FILE_COLUMNS}
+                                FROM files
+                                WHERE id = %(id)s AND deleted AND deleted_at <= %(cutoff)s
+
+                                FOR UPDATE SKIP LOCKED;""",
+                            dict(id=file_id,
+                                 cutoff=cutoff))
+
+                row = con.fetchone()
+
+                # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+                # another process is reaping it, or it was restored
+                # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+                if row is None:
+                    failures.pop(file_id, None)
+                    continue
+
+                file = cache.get_file(key=row[2]) or cache.make_file(row=row)
+
+                con.execute("""DELETE FROM files
+                               WHERE id = %(id)s;""",
+                            dict(id=file_id))
+
+                refs = uploads.dereference(digest=file.digest,
+                                           con=con) if file.digest is not None else None
+
+        except Exception as error:
+            attempts = failures.get(file_id, [0, 0])[0] + 1
+            failures[file_id] = [attempts, monotonic() + min(2 ** attempts * 10, 3600)]
+
+            console.error(text=f"Failed to reap file {file_id} ({attempts} attempts), it will be retried.\n\n{error}")
+            continue
+
+        failures.pop(file_id, None)
+        cache.remove_file(file=file)
+        reaped += 1
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # the row is gone for good by now, so a failure here only
+        # leaves unreferenced bytes behind: collect_orphans retries
+        # the blob, a stray link or derivative is harmless
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        try:
+            uploads.remove(file=file)
+
+            if refs is not None and refs <= 0:
+                uploads.collect(digest=file.digest)
+
+        except Exception as error:
+            console.error(text=f"Failed to remove the contents of reaped file {file_id}.\n\n{error}")
+
+        sleep(1 / files_per_second)
+
+    return reaped
+
+def run(batch_size: Optional[int] = 100,
+        files_per_second: Optional[float] = 50,
+        undo_seconds: Optional[int] = 300,
+        interval: Optional[float] = 10):
+    """Reaps deleted files forever, checking for more every interval seconds once there are none left to reap.
+
+    Each time the queue is empty, blobs that nothing refers to any more are collected too."""
+
+    while True:
+        try:
+            reaped = 0
+
+            while True:
+                count = reap(batch_size=batch_size,
+                             files_per_second=files_per_second,
+                             undo_seconds=undo_seconds)
+
+                if not count:
+                    break
+
+                reaped += count
+
+            if reaped:
+                console.verbose(text=f"Reaped {reaped} deleted files.")
+
+            uploads.collect_orphans(limit=batch_size)
+
+        except Exception as error:
+            console.error(text=f"Failed to reap deleted files.\n\n{error}")
+
+        sleep(interval)
@@ -0,0 +1,565 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
+
+# -----------------
+# Builtin libraries
+# -----------------
+from collections import defaultdict, OrderedDict
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util.blueprints import File, URL, User
+from util.keys import hash_token
+
+
+USER_COLUMNS = "id, username, password, admin, token, created_at"
+FILE_COLUMNS = "id, owner_id, key, deleted, created_at, digest, size, mimetype, width, height"
+URL_COLUMNS = "id, owner_id, key, url, created_at"
+
+
+class Registry:
+    """This is the in-memory index of every user, file and URL that the server knows about.
+
+    Every lookup the routes make (by key, target URL, user ID, token or username) is a single dict access.
+    Tokens are indexed in the form they're stored in, which is a SHA-256 hash if hash_tokens is enabled.
+    Files and URLs are stored oldest first in ordered dicts, so adding the newest item is an append
+    and listing them newest first is just a reversed walk."""
+
+    def __init__(self,
+                 superuser: User,
+                 hash_tokens: Optional[bool] = False):
+        self.superuser = superuser
+        self.hash_tokens = hash_tokens
+
+        # ============
+        # User indexes
+        # ============
+        self._users = OrderedDict()
+        self._tokens = {}
+        self._usernames = {}
+
+        # ====================
+        # File and URL indexes
+        # ====================
+        self._files = OrderedDict()
+        self._urls = OrderedDict()
+        self._targets = {}
+
+        # -------------------------------------------
+        # per-owner secondary indexes, keyed by owner
+        # ID and then by file or URL key
+        # -------------------------------------------
+        self._owner_files = defaultdict(OrderedDict)
+        self._owner_urls = defaultdict(OrderedDict)
+
+        self.add_user(user=superuser)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # the full registry never needs to ask Postgres anything
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    bounded = False
+    database = None
+
+    # ==================
+    # Row object helpers
+    # ==================
+    def make_user(self,
+                  row: Tuple) -> User:
+        """Builds a user from a row selected with USER_COLUMNS."""
+
+        return User(id=row[0],
+                    username=row[1],
+                    password=row[2],
+                    admin=row[3],
+                    token=row[4],
+                    created_at=row[5])
+
+    def make_file(self,
+                  row: Tuple) -> File:
+        """Builds a file from a row selected with FILE_COLUMNS, resolving the owner through the ID index."""
+
+        return File(id=row[0],
+                    key=row[2],
+                    deleted=row[3],
+                    created_at=row[4],
+                    digest=row[5],
+                    size=row[6],
+                    mimetype=row[7],
+                    width=row[8],
+                    height=row[9],
+                    owner=self.user_by_id(id=row[1]))
+
+    def make_url(self,
+                 row: Tuple) -> URL:
+        """Builds a shortened URL from a row selected with URL_COLUMNS, resolving the owner through the ID index."""
+
+        return URL(id=row[0],
+                   key=row[2],
+                   url=row[3],
+                   created_at=row[4],
+                   owner=self.user_by_id(id=row[1]))
+
+    # =====
+    # Users
+    # =====
+    @property
+    def users(self) -> List[User]:
+        """Returns every user in order of creation, starting with the superuser."""
+
+        return list(self._users.values())
+
+    def add_user(self,
+                 user: User):
+        """Adds a user to the user indexes."""
+
+        self._users[user.id] = user
+        self._tokens[user.token] = user
+        self._usernames[user.username] = user
+
+    def remove_user(self,
+                    user: User):
+        """Removes a user from the user indexes.
+
+        Their files and URLs are left alone, just like the database rows."""
+
+        self._users.pop(user.id, None)
+        self._tokens.pop(user.token, None)
+        self._usernames.pop(user.username, None)
+
+    def update_user(self,
+                    user: User,
+                    **new_values: dict):
+        """Edits a user in place and re-indexes them.
+
+        The object is edited rather than replaced so that every file and URL owned by the user keeps pointing at the current data."""
+
+        self._tokens.pop(user.token, None)
+        self._usernames.pop(user.username, None)
+
+        for name, value in new_values.items():
+            setattr(user, name, value)
+
+        self._tokens[user.token] = user
+        self._usernames[user.username] = user
+
+    def user_by_id(self,
+                   id: int) -> Optional[User]:
+        """Returns the user with the given ID, or None."""
+
+        return self._users.get(id)
+
+    def user_by_token(self,
+                      token: str) -> Optional[User]:
+        """Returns the user with the given API token, or None.
+
+        If tokens are stored hashed, the given token is hashed before the lookup."""
+
+        return self._tokens.get(hash_token(token=token) if self.hash_tokens else token)
+
+    def user_by_username(self,
+                         username: str) -> Optional[User]:
+        """Returns the user with the given username, or None."""
+
+        return self._usernames.get(username)
+
+    # =====
+    # Files
+    # =====
+    @property
+    def files(self) -> Iterator[File]:
+        """Returns every file, newest first."""
+
+        return reversed(self._files.values())
+
+    def add_file(self,
+                 file: File):
+        """Adds a file to the file indexes as the newest file."""
+
+        self._files[file.key] = file
+        self._owner_files[file.owner.id if file.owner else None][file.key] = file
+
+    def remove_file(self,
+                    file: File):
+        """Removes a file from the file indexes."""
+
+        self._files.pop(file.key, None)
+        self._owner_files[file.owner.id if file.owner else None].pop(file.key, None)
+
+    def get_file(self,
+                 key: str) -> Optional[File]:
+        """Returns the file with the given key, or None."""
+
+        return self._files.get(key)
+
+    def files_of(self,
+                 owner: Union[User, int]) -> Iterator[File]:
+        """Returns every file owned by the given user or user ID, newest first."""
+
+        owner_id = owner.id if isinstance(owner, User) else owner
+
+        return reversed(self._owner_files.get(owner_id, OrderedDict()).values())
+
+    def has_file(self,
+                 key: str) -> bool:
+        """Checks whether or not a file key is taken."""
+
+        return key in self._files
+
+    def count_files(self) -> int:
+        """Returns how many files exist."""
+
+        return len(self._files)
+
+    # ====
+    # URLs
+    # ====
+    @property
+    def urls(self) -> Iterator[URL]:
+        """Returns every shortened URL, newest first."""
+
+        return reversed(self._urls.values())
+
+    def add_url(self,
+                url: URL):
+        """Adds a shortened URL to the URL indexes as the newest URL."""
+
+        self._urls[url.key] = url
+        self._targets[url.url] = url
+        self._owner_urls[url.owner.id if url.owner else None][url.key] = url
+
+    def remove_url(self,
+                   url: URL):
+        """Removes a shortened URL from the URL indexes."""
+
+        self._urls.pop(url.key, None)
+        self._owner_urls[url.owner.id if url.owner else None].pop(url.key, None)
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # only drop the target if it still points at us
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        if self._targets.get(url.url) is url:
+            del self._targets[url.url]
+
+    def remove_urls(self,
+                    urls: Iterable[URL]):
+        """Removes several shortened URLs from the URL indexes in one go."""
+
+        for url in urls:
+            self.remove_url(url=url)
+
+    def get_url(self,
+                key: str) -> Optional[URL]:
+        """Returns the shortened URL with the given key, or None."""
+
+        return self._urls.get(key)
+
+    def url_by_target(self,
+                      target: str) -> Optional[URL]:
+        """Returns the shortened URL that redirects to the given target, or None."""
+
+        return self._targets.get(target)
+
+    def urls_of(self,
+                owner: Union[User, int]) -> Iterator[URL]:
+        """Returns every shortened URL owned by the given user or user ID, newest first."""
+
+        owner_id = owner.id if isinstance(owner, User) else owner
+
+        return reversed(self._owner_urls.get(owner_id, OrderedDict()).values())
+
+    def has_url(self,
+                key: str) -> bool:
+        """Checks whether or not a URL key is taken."""
+
+        return key in self._urls
+
+    def count_urls(self) -> int:
+        """Returns how many shortened URLs exist."""
+
+        return len(self._urls)
+
+
+class BoundedRegistry(Registry):
+    """This is a registry that only keeps users and the most recently used files and URLs in memory.
+
+    Files and URLs live in LRU ordered dicts capped at max_files and max_urls. Anything that isn't resident is looked up
+    with an indexed point query against Postgres and then kept, evicting the least recently used item.
+    Listings are always read from Postgres page_size rows at a time, so memory use stays flat no matter how many uploads
+    exist."""
+
+    bounded = True
+
+    def __init__(self,
+                 superuser: User,
+                 max_files: int,
+                 max_urls: int,
+                 page_size: Optional[int] = 1000,
+                 hash_tokens: Optional[bool] = False):
+        super().__init__(superuser=superuser,
+                         hash_tokens=hash_tokens)
+
+        self.max_files = max_files
+        self.max_urls = max_urls
+        self.page_size = page_size
+
+        self.hits = 0
+        self.misses = 0
+
+    def _query(self,
+               query: str,
+               values: dict) -> List[Tuple]:
+        """Runs a read query against Postgres and returns every row."""
+
+        with self.database.cursor() as con:
+            con.execute(query,
+                        values)
+
+            return con.fetchall()
+
+    def _listing(self,
+                 table: str,
+                 columns: str,
+                 condition: Optional[str] = "TRUE",
+                 values: Optional[dict] = None) -> Iterator[Tuple]:
+        """Yields every row of a table matching the condition, newest first, reading page_size rows at a time.
+
+        Pages are fetched by keyset on (created_at, id) rather than with OFFSET, so each one is an index range scan
+        however deep into the listing it is, and no connection is held between pages. The columns must start with id
+        and have created_at fifth, as FILE_COLUMNS and URL_COLUMNS do."""
+
+        values = dict(values or {},
+                      limit=self.page_size)
+        after = ""
+
+        while True:
+            rows = self._query(f"""SELECT {columns}
+                                   FROM {table}
+                                   WHERE {condition}{after}
+                                   ORDER BY created_at DESC, id DESC
+                                   LIMIT %(limit)s;""",
+                               values)
+
+            yield from rows
+
+            if len(rows) < self.page_size:
+                return
+
+            values.update(created_at=rows[-1][4],
+                          id=rows[-1][0])
+            after = " AND (created_at, id) < (%(created_at)s, %(id)s)"
+
+    def _exists(self,
+                table: str,
+                key: str) -> bool:
+        """Checks whether or not a key exists in a table without reading or keeping its row."""
+
+        return self._query(f"""SELECT EXISTS (SELECT 1 FROM {table} WHERE key = %(key)s);""",
+                           dict(key=key))[0][0]
+
+    def _remember(self,
+                  store: OrderedDict,
+                  key: str,
+                  item: Any,
+                  limit: int):
+        """Marks an item as the most recently used one, evicting the least recently used items past the limit."""
+
+        store[key] = item
+        store.move_to_end(key)
+
+        while len(store) > limit:
+            store.popitem(last=False)
+
+    def _lookup(self,
+                store: OrderedDict,
+                key: str) -> Any:
+        """Returns a resident item and marks it as recently used, or None if it isn't resident."""
+
+        item = store.get(key)
+
+        if item is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        store.move_to_end(key)
+
+        return item
+
+    # =====
+    # Files
+    # =====
+    @property
+    def files(self) -> Iterator[File]:
+        """Returns every file, newest first, straight from Postgres."""
+
+        rows = self._listing(table="files",
+                             columns=FILE_COLUMNS)
+
+        return (self._files.get(row[2]) or self.make_file(row=row) for row in rows)
+
+    def add_file(self,
+                 file: File):
+        """Keeps a file resident as the most recently used file."""
+
+        self._remember(store=self._files,
+                       key=file.key,
+                       item=file,
+                       limit=self.max_files)
+
+    def remove_file(self,
+                    file: File):
+        """Forgets a resident file."""
+
+        self._files.pop(file.key, None)
+
+    def get_file(self,
+                 key: str) -> Optional[File]:
+        """Returns the file with the given key, reading it from Postgres if it isn't resident."""
+
+        file = self._lookup(store=self._files,
+                            key=key)
+
+        if file is not None:
+            return file
+
+        rows = self._query(f"""SELECT {FILE_COLUMNS}
+                               FROM files
+                               WHERE key = %(key)s;""",
+                           dict(key=key))
+
+        if not rows:
+            return None
+
+        file = self.make_file(row=rows[0])
+        self.add_file(file=file)
+
+        return file
+
+    def files_of(self,
+                 owner: Union[User, int]) -> Iterator[File]:
+        """Returns every file owned by the given user or user ID, newest first, straight from Postgres."""
+
+        owner_id = owner.id if isinstance(owner, User) else owner
+        rows = self._listing(table="files",
+                             columns=FILE_COLUMNS,
+                             condition="owner_id = %(owner_id)s",
+                             values=dict(owner_id=owner_id))
+
+        return (self._files.get(row[2]) or self.make_file(row=row) for row in rows)
+
+    def has_file(self,
+                 key: str) -> bool:
+        """Checks whether or not a file key is taken.
+
+        Keys are probed for every new upload and are almost never taken, so the answer is read without keeping the file."""
+
+        return key in self._files or self._exists(table="files",
+                                                  key=key)
+
+    def count_files(self) -> int:
+        """Returns how many files exist, straight from Postgres."""
+
+        return self._query("""SELECT count(*)
+                              FROM files;""",
+                           dict())[0][0]
+
+    # ====
+    # URLs
+    # ====
+    @property
+    def urls(self) -> Iterator[URL]:
+        """Returns every shortened URL, newest first, straight from Postgres."""
+
+        rows = self._listing(table="urls",
+                             columns=URL_COLUMNS)
+
+        return (self._urls.get(row[2]) or self.make_url(row=row) for row in rows)
+
+    def add_url(self,
+                url: URL):
+        """Keeps a shortened URL resident as the most recently used URL."""
+
+        self._remember(store=self._urls,
+                       key=url.key,
+                       item=url,
+                       limit=self.max_urls)
+
+    def remove_url(self,
+                   url: URL):
+        """Forgets a resident shortened URL."""
+
+        self._urls.pop(url.key, None)
+
+    def get_url(self,
+                key: str) -> Optional[URL]:
+        """Returns the shortened URL with the given key, reading it from Postgres if it isn't resident."""
+
+        url = self._lookup(store=self._urls,
+                           key=key)
+
+        if url is not None:
+            return url
+
+        rows = self._query(f"""SELECT {URL_COLUMNS}
+                               FROM urls
+                               WHERE key = %(key)s;""",
+                           dict(key=key))
+
+        if not rows:
+            return None
+
+        url = self.make_url(row=rows[0])
+        self.add_url(url=url)
+
+        return url
+
+    def url_by_target(self,
+                      target: str) -> Optional[URL]:
+        """Returns the shortened URL that redirects to the given target, or None.
+
+        Targets are only ever looked up when shortening, so they aren't kept resident."""
+
+        rows = self._query(f"""SELECT {URL_COLUMNS}
+                               FROM urls
+                               WHERE url = %(url)s
+                               LIMIT 1;""",
+                           dict(url=target))
+
+        return self.make_url(row=rows[0]) if rows else None
+
+    def urls_of(self,
+                owner: Union[User, int]) -> Iterator[URL]:
+        """Returns every shortened URL owned by the given user or user ID, newest first, straight from Postgres."""
+
+        owner_id = owner.id if isinstance(owner, User) else owner
+        rows = self._listing(table="urls",
+                             columns=URL_COLUMNS,
+                             condition="owner_id = %(owner_id)s",
+                             values=dict(owner_id=owner_id))
+
+        return (self._urls.get(row[2]) or self.make_url(row=row) for row in rows)
+
+    def has_url(self,
+                key: str) -> bool:
+        """Checks whether or not a URL key is taken.
+
+        Keys are probed for every new URL and are almost never taken, so the answer is read without keeping the URL."""
+
+        return key in self._urls or self._exists(table="urls",
+                                                 key=key)
+
+    def count_urls(self) -> int:
+        """Returns how many shortened URLs exist, straight from Postgres."""
+
+        return self._query("""SELECT count(*)
+                              FROM urls;""",
+                           dict())[0][0]
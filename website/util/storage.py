@@ -0,0 +1,320 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# Upload contents (blobs) are kept in a storage backend, chosen with config.storage.backend.
+#
+# local keeps them on this machine's disk, which lets uploads be hard linked into
+# data/uploads and sent with os.sendfile. s3 keeps them in any S3-compatible object
+# store (AWS, MinIO, Ceph...) so storage can grow separately from the web servers;
+# it needs the boto3 package, which is only imported if the s3 backend is chosen.
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, BinaryIO, Iterator, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from tempfile import mkstemp
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import get_hub
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+class Stat:
+    """This is the size and modification time of a stored object.
+
+    The attribute names match os.stat_result, so either can be used to build cache validators."""
+
+    def __init__(self,
+                 size: int,
+                 mtime: float):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_mtime_ns = int(mtime * 1e9)
+
+
+class LocalStorage:
+    """This stores objects as files under a folder on the local disk, fanned out by the first two characters of their name."""
+
+    local = True
+
+    def __init__(self,
+                 root: str):
+        self.root = root
+
+        os.makedirs(root,
+                    exist_ok=True)
+
+    def path(self,
+             name: str) -> str:
+        """Returns where an object is stored."""
+
+        return f"{self.root}/{name[:2]}/{name}"
+
+    def put(self,
+            name: str,
+            stream: BinaryIO):
+        """Stores an object, reading it from stream in chunks. The object only appears once it's fully written."""
+
+        path = self.path(name=name)
+        os.makedirs(os.path.dirname(path),
+                    exist_ok=True)
+
+        descriptor, temp_path = mkstemp(prefix=".object-",
+                                        dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(descriptor, "wb") as temp:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    temp.write(chunk)
+
+                temp.flush()
+                os.fsync(temp.fileno())
+
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+
+    def put_file(self,
+                 name: str,
+                 path: str):
+        """Stores a local file as an object by moving it into place, so the file is gone afterwards."""
+
+        destination = self.path(name=name)
+        os.makedirs(os.path.dirname(destination),
+                    exist_ok=True)
+
+        os.replace(path, destination)
+
+    def open(self,
+             name: str,
+             offset: Optional[int] = 0,
+             length: Optional[int] = None) -> Iterator[bytes]:
+        """Streams an object, or length bytes of it from offset, in chunks."""
+
+        with open(file=self.path(name=name), mode="rb") as file:
+            file.seek(offset)
+
+            while length is None or length > 0:
+                chunk = file.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+
+                if not chunk:
+                    return
+
+                if length is not None:
+                    length -= len(chunk)
+
+                yield chunk
+
+    def stat(self,
+             name: str) -> Optional[Stat]:
+        """Returns the size and modification time of an object, or None if it doesn't exist."""
+
+        try:
+            stat = os.stat(self.path(name=name))
+
+        except FileNotFoundError:
+            return None
+
+        return Stat(size=stat.st_size,
+                    mtime=stat.st_mtime)
+
+    def delete(self,
+               name: str):
+        """Deletes an object, if it exists."""
+
+        if os.path.exists(self.path(name=name)):
+            os.remove(self.path(name=name))
+
+
+class S3Storage:
+    """This stores objects in a bucket of an S3-compatible object store.
+
+    Objects are uploaded with a streaming multipart upload in parts of part_size bytes, so memory use doesn't grow with
+    the size of an upload, and can be read back whole or as a byte range. boto3 blocks, so every call to the store runs
+    in gevent's thread pool and only the calling greenlet waits for it."""
+
+    local = False
+
+    def __init__(self,
+                 bucket: str,
+                 prefix: Optional[str] = "",
+                 endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None,
+                 access_key: Optional[str] = None,
+                 secret_key: Optional[str] = None,
+                 part_size: Optional[int] = 8 * 1024**2):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, 5 * 1024**2)
+
+        self.client = boto3.client("s3",
+                                   endpoint_url=endpoint_url,
+                                   region_name=region,
+                                   aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key)
+
+    def _call(self,
+              method: str,
+              **kwargs: Any) -> Any:
+        """Calls a boto3 client method in the thread pool."""
+
+        return get_hub().threadpool.apply(getattr(self.client, method), kwds=kwargs)
+
+    def put(self,
+            name: str,
+            stream: BinaryIO):
+        """Stores an object with a multipart upload, reading it from stream one part at a time.
+
+        Objects smaller than a single part are stored with one PUT instead. A failed upload is aborted, so no
+        half-written object or orphaned parts are left behind."""
+
+        first = stream.read(self.part_size)
+
+        if len(first) < self.part_size:
+            self._call("put_object",
+                       Bucket=self.bucket,
+                       Key=self.prefix + name,
+                       Body=first)
+
+            return
+
+        upload_id = self._call("create_multipart_upload",
+                               Bucket=self.bucket,
+                               Key=self.prefix + name)["UploadId"]
+        parts = []
+
+        try:
+            part = first
+
+            while part:
+                uploaded = self._call("upload_part",
+                                      Bucket=self.bucket,
+                                      Key=self.prefix + name,
+                                      UploadId=upload_id,
+                                      PartNumber=len(parts) + 1,
+                                      Body=part)
+
+                parts.append(dict(ETag=uploaded["ETag"],
+                                  PartNumber=len(parts) + 1))
+
+                part = stream.read(self.part_size)
+
+            self._call("complete_multipart_upload",
+                       Bucket=self.bucket,
+                       Key=self.prefix + name,
+                       UploadId=upload_id,
+                       MultipartUpload=dict(Parts=parts))
+
+        except BaseException:
+            self._call("abort_multipart_upload",
+                       Bucket=self.bucket,
+                       Key=self.prefix + name,
+                       UploadId=upload_id)
+            raise
+
+    def put_file(self,
+                 name: str,
+                 path: str):
+        """Stores a local file as an object and deletes the file."""
+
+        with open(file=path, mode="rb") as file:
+            self.put(name=name,
+                     stream=file)
+
+        os.remove(path)
+
+    def open(self,
+             name: str,
+             offset: Optional[int] = 0,
+             length: Optional[int] = None) -> Iterator[bytes]:
+        """Streams an object, or length bytes of it from offset, in chunks, using a ranged GET.
+
+        The whole object is read with a plain GET, since S3 rejects the range bytes=0- on an empty object."""
+
+        if length == 0:
+            return
+
+        options = dict()
+
+        if offset or length is not None:
+            options["Range"] = f"bytes={offset}-" + (str(offset + length - 1) if length is not None else "")
+
+        body = self._call("get_object",
+                          Bucket=self.bucket,
+                          Key=self.prefix + name,
+                          **options)["Body"]
+
+        try:
+            while True:
+                chunk = get_hub().threadpool.apply(body.read, (CHUNK_SIZE,))
+
+                if not chunk:
+                    return
+
+                yield chunk
+
+        finally:
+            body.close()
+
+    def stat(self,
+             name: str) -> Optional[Stat]:
+        """Returns the size and modification time of an object, or None if it doesn't exist."""
+
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self._call("head_object",
+                              Bucket=self.bucket,
+                              Key=self.prefix + name)
+
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+
+            raise
+
+        return Stat(size=head["ContentLength"],
+                    mtime=head["LastModified"].timestamp())
+
+    def delete(self,
+               name: str):
+        """Deletes an object. Deleting an object that doesn't exist isn't an error."""
+
+        self._call("delete_object",
+                   Bucket=self.bucket,
+                   Key=self.prefix + name)
+
+
+def create(config: Any,
+           root: str) -> Any:
+    """Returns the storage backend chosen in the storage section of the configuration.
+
+    root is where the local backend keeps its objects."""
+
+    if config.backend == "s3":
+        return S3Storage(bucket=config.s3.bucket,
+                         prefix=config.s3.prefix,
+                         endpoint_url=config.s3.endpoint_url,
+                         region=config.s3.region,
+                         access_key=config.s3.access_key,
+                         secret_key=config.s3.secret_key,
+                         part_size=config.s3.part_size_megabytes * 1024**2)
+
+    return LocalStorage(root=root)
@@ -0,0 +1,282 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, BinaryIO, Callable, Iterator, List, Optional, Tuple, Union
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from datetime import datetime
+from secrets import token_hex
+from ssl import SSLSocket
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from flask import request, Response
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+from gevent.ssl import SSLSocket as GeventSSLSocket
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+class FileBody:
+    """This is a response body made of parts of a file, optionally with bytes in between (e.g: multipart boundaries).
+
+    Each part is either bytes or an (offset, length) pair into the file. Iterating reads the file in chunks, which works
+    on any WSGI server, but SendfileHandler recognises this class and has the kernel copy the file parts straight to
+    the socket with os.sendfile instead."""
+
+    def __init__(self,
+                 file: BinaryIO,
+                 parts: List[Union[bytes, Tuple[int, int]]]):
+        self.file = file
+        self.parts = parts
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            offset, length = part
+            self.file.seek(offset)
+
+            while length > 0:
+                chunk = self.file.read(min(CHUNK_SIZE, length))
+
+                if not chunk:
+                    return
+
+                length -= len(chunk)
+                yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class ObjectBody:
+    """This is a response body made of byte ranges of an object in a storage backend, with bytes in between.
+
+    Each (offset, length) part is streamed from the backend with a ranged read, see util.storage."""
+
+    def __init__(self,
+                 storage: Any,
+                 name: str,
+                 parts: List[Union[bytes, Tuple[int, int]]]):
+        self.storage = storage
+        self.name = name
+        self.parts = parts
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            offset, length = part
+
+            yield from self.storage.open(name=self.name,
+                                         offset=offset,
+                                         length=length)
+
+
+class SendfileHandler(WSGIHandler):
+    """This is gevent's WSGI handler, but sends FileBody responses with os.sendfile.
+
+    The socket is non-blocking, so whenever it's full the greenlet waits on the hub for it to drain rather than
+    blocking the whole process. TLS sockets can't be written to by the kernel, so they fall back to the usual path."""
+
+    def encrypted(self) -> bool:
+        """Checks whether or not this connection is TLS, in which case sendfile would write plaintext past the encryption.
+
+        gevent's SSLSocket isn't a subclass of the standard library's, so the server and the request are asked too."""
+
+        return isinstance(self.socket, (SSLSocket, GeventSSLSocket)) \
+               or getattr(self.server, "ssl_enabled", False) \
+               or (self.environ or {}).get("wsgi.url_scheme") == "https"
+
+    def process_result(self):
+        if not isinstance(self.result, FileBody) or self.encrypted() or self.response_use_chunked:
+            return super().process_result()
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # flushes the status and headers
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        self.write(b"")
+
+        socket_fd = self.socket.fileno()
+        file_fd = self.result.file.fileno()
+
+        for part in self.result.parts:
+            if isinstance(part, bytes):
+                self.write(part)
+                continue
+
+            offset, length = part
+
+            while length > 0:
+                try:
+                    sent = os.sendfile(socket_fd, file_fd, offset, min(length, 0x7ffff000))
+
+                except BlockingIOError:
+                    wait_write(socket_fd)
+                    continue
+
+                if sent == 0:
+                    return
+
+                offset += sent
+                length -= sent
+                self.response_length += sent
+
+
+def satisfiable_ranges(size: int) -> Optional[List[Tuple[int, int]]]:
+    """Returns the byte ranges of the request as (offset, length) pairs, clamped to size.
+
+    None means there's no usable Range header and the whole file should be sent, an empty list means none of the
+    ranges can be satisfied. Overlapping ranges aren't merged, but a request with more than 16 ranges is treated as
+    if it had none, so a client can't make us send the same bytes thousands of times over."""
+
+    ranges = request.range
+
+    if ranges is None or ranges.units != "bytes" or len(ranges.ranges) > 16:
+        return None
+
+    satisfiable = []
+
+    for start, stop in ranges.ranges:
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # a negative start is a suffix range (e.g: the last 500 bytes)
+        # and a stop of None runs to the end of the file
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        if start < 0:
+            start = max(size + start, 0)
+            stop = size
+
+        stop = size if stop is None else min(stop, size)
+
+        if start < stop:
+            satisfiable.append((start, stop - start))
+
+    return satisfiable
+
+def range_applies(etag: str,
+                  last_modified: datetime) -> bool:
+    """Checks the If-Range header, which asks for the ranges only if the file hasn't changed since the client last saw it."""
+
+    if_range = request.if_range
+
+    if if_range.etag is not None:
+        return if_range.etag == etag
+
+    if if_range.date is not None:
+        return if_range.date.replace(tzinfo=None) == last_modified
+
+    return True
+
+def ranged_response(size: int,
+                    body: Callable[[List[Union[bytes, Tuple[int, int]]]], Any],
+                    mimetype: str,
+                    etag: str,
+                    last_modified: datetime,
+                    download_name: Optional[str] = None) -> Response:
+    """Builds the response for a file of the given size, or for the byte ranges of it the request asks for.
+
+    One range is sent as a plain 206, several as a multipart/byteranges 206, and ranges that lie wholly past the end
+    of the file get a 416. body is called with the parts to send and returns the response body.
+
+    If download_name is given, the file is sent as an attachment with that name."""
+
+    ranges = satisfiable_ranges(size=size) if range_applies(etag=etag, last_modified=last_modified) else None
+
+    if ranges == []:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+
+        return response
+
+    if ranges is None:
+        response = Response(response=body([(0, size)]),
+                            status=200,
+                            mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = size
+
+    elif len(ranges) == 1:
+        offset, length = ranges[0]
+
+        response = Response(response=body([(offset, length)]),
+                            status=206,
+                            mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = length
+        response.headers["Content-Range"] = f"bytes {offset}-{offset + length - 1}/{size}"
+
+    else:
+        boundary = token_hex(nbytes=16)
+        parts = []
+
+        for offset, length in ranges:
+            parts.append(f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {offset}-{offset + length - 1}/{size}\r\n\r\n".encode())
+            parts.append((offset, length))
+
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+        response = Response(response=body(parts),
+                            status=206,
+                            content_type=f"multipart/byteranges; boundary={boundary}",
+                            direct_passthrough=True)
+        response.content_length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+    response.headers["Accept-Ranges"] = "bytes"
+
+    if download_name is not None:
+        response.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+
+    return response
+
+def send_ranges(path: str,
+                mimetype: str,
+                etag: str,
+                last_modified: datetime,
+                download_name: Optional[str] = None) -> Response:
+    """Sends a local file, or the byte ranges of it the request asks for.
+
+    The body is a FileBody, so it's sent with os.sendfile under SendfileHandler."""
+
+    return ranged_response(size=os.stat(path).st_size,
+                           body=lambda parts: FileBody(file=open(file=path, mode="rb"),
+                                                       parts=parts),
+                           mimetype=mimetype,
+                           etag=etag,
+                           last_modified=last_modified,
+                           download_name=download_name)
+
+def send_object_ranges(storage: Any,
+                       name: str,
+                       size: int,
+                       mimetype: str,
+                       etag: str,
+                       last_modified: datetime,
+                       download_name: Optional[str] = None) -> Response:
+    """Sends an object from a storage backend, or the byte ranges of it the request asks for, streaming it as it's read."""
+
+    return ranged_response(size=size,
+                           body=lambda parts: ObjectBody(storage=storage,
+                                                         name=name,
+                                                         parts=parts),
+                           mimetype=mimetype,
+                           etag=etag,
+                           last_modified=last_modified,
+                           download_name=download_name)
@@ -0,0 +1,144 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+# These are the CPU-bound tasks that get handed to the worker pool (see util.workers).
+# They're plain module-level functions that take and return picklable values, so they
+# can be sent to another process.
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import List, Tuple
+
+# -----------------
+# Builtin libraries
+# -----------------
+from io import BytesIO
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+import util.utilities as utils
+
+from util import compression, highlighting
+from util.constants import config, markdown
+
+
+def optimise_image(data: bytes) -> bytes:
+    """Returns an optimised copy of an encoded image."""
+
+    optimised = BytesIO()
+
+    utils.optimise_image(source=BytesIO(data),
+                         destination=optimised)
+
+    return optimised.getvalue()
+
+def make_thumbnail(path: str) -> bytes:
+    """Returns a JPEG thumbnail of the image stored at path."""
+
+    thumbnail = BytesIO()
+
+    with open(file=path, mode="rb") as source:
+        utils.make_thumbnail(source=source,
+                             destination=thumbnail)
+
+    return thumbnail.getvalue()
+
+def resize_image(path: str,
+                 width: int,
+                 height: int,
+                 fit: str,
+                 quality: int) -> bytes:
+    """Returns a resized copy of the image stored at path, in the same format."""
+
+    resized = BytesIO()
+
+    with open(file=path, mode="rb") as source:
+        utils.resize_image(source=source,
+                           destination=resized,
+                           width=width,
+                           height=height,
+                           fit=fit,
+                           quality=quality)
+
+    return resized.getvalue()
+
+def transcode_image(path: str,
+                    image_format: str,
+                    quality: int) -> bytes:
+    """Returns a copy of the image stored at path, re-encoded in another format."""
+
+    transcoded = BytesIO()
+
+    with open(file=path, mode="rb") as source:
+        utils.transcode_image(source=source,
+                              destination=transcoded,
+                              image_format=image_format,
+                              quality=quality)
+
+    return transcoded.getvalue()
+
+def render_markdown(content: str) -> str:
+    """Renders markdown (and any highlighted code blocks within it) to HTML."""
+
+    return markdown(content)
+
+def highlight_code(code: str,
+                   lang: str,
+                   first_line: int) -> str:
+    """Highlights a code file, or one page of it, as HTML."""
+
+    return highlighting.highlight(code=code,
+                                  lang=lang,
+                                  style=config.code_style,
+                                  max_bytes=config.highlighting.max_bytes,
+                                  first_line=first_line)
+
+def index_lines(path: str,
+                lines_per_page: int) -> Tuple[List[int], int, int]:
+    """Scans a text file once and returns the byte offset each page of lines_per_page lines starts at, its size and its line count."""
+
+    offsets = [0]
+    newlines = 0
+    position = 0
+    boundary = lines_per_page
+    last = b""
+
+    with open(file=path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(1024**2), b""):
+            count = chunk.count(b"\n")
+            search = 0
+
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            # newlines are only looked for one by one in the chunks
+            # where a page boundary falls, the rest are just counted
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            while newlines + count >= boundary:
+                for _ in range(boundary - newlines):
+                    search = chunk.index(b"\n", search) + 1
+                    count -= 1
+
+                newlines = boundary
+                offsets.append(position + search)
+                boundary += lines_per_page
+
+            newlines += count
+            position += len(chunk)
+            last = chunk[-1:]
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # a file ending right on a page boundary would otherwise
+    # get an empty last page
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    if len(offsets) > 1 and offsets[-1] >= position:
+        offsets.pop()
+
+    return offsets, position, newlines + (1 if last not in (b"", b"\n") else 0)
+
+def precompress(path: str):
+    """Writes the gzip (and brotli) sidecars of a stored file."""
+
+    compression.precompress(path=path)
@@ -0,0 +1,577 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, BinaryIO, Dict, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from calendar import timegm
+from hashlib import sha256
+from mimetypes import guess_type
+from tempfile import mkstemp
+from time import perf_counter
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import sleep, spawn
+from psycopg2.extras import execute_values
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+import util.utilities as utils
+
+from util import compression, console, constants, quotas, tasks
+from util.blueprints import File
+from util.constants import config
+from util.storage import Stat
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# uploads are kept out of static/, which Flask serves as it
+# is, so they can only be reached through the file routes
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+UPLOAD_DIR = "data/uploads"
+BLOB_DIR = "data/blobs"
+DERIVATIVE_DIR = "data/derivatives"
+OBJECT_DIR = f"{DERIVATIVE_DIR}/objects"
+CHUNK_SIZE = 64 * 1024
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# running totals for each pipeline stage, as stage: [count,
+# total seconds], which are reported through /api/stats
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+timings = {}
+
+
+class StagedUpload:
+    """This is an upload that has been fully written to a temporary file and hashed, but not yet given a key."""
+
+    def __init__(self,
+                 path: str,
+                 digest: str,
+                 size: int,
+                 stages: Dict[str, float]):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.stages = stages
+
+
+def record(stages: Dict[str, float]):
+    """Adds the timings of one upload to the running totals."""
+
+    for stage, seconds in stages.items():
+        totals = timings.setdefault(stage, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+def stats() -> dict:
+    """Returns the average time spent in each stage of the upload pipeline."""
+
+    return {stage: dict(count=count,
+                        average=round(total / count, 6)) for stage, (count, total) in timings.items()}
+
+def upload_path(key: str) -> str:
+    """Returns where the upload with the given key is stored.
+
+    Uploads are fanned out into config.uploads.depth levels of directories named after successive config.uploads.fan_out
+    character slices of their key (e.g: ab/cd/abcdefgh.png), so no directory grows huge. A depth of 0 keeps them flat."""
+
+    shards = [key[level * config.uploads.fan_out:(level + 1) * config.uploads.fan_out] for level in range(config.uploads.depth)]
+
+    return "/".join([UPLOAD_DIR] + shards + [key])
+
+def flat_path(key: str) -> str:
+    """Returns where the upload with the given key was stored before uploads were sharded."""
+
+    return f"{UPLOAD_DIR}/{key}"
+
+def locate(key: str) -> Optional[str]:
+    """Returns where the upload with the given key actually is, or None if it doesn't exist.
+
+    Both layouts are checked, so uploads can be read while migrate_layout is still moving them."""
+
+    for path in (upload_path(key=key), flat_path(key=key)):
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+def relocate():
+    """Moves uploads, the blob store and the derivative caches out of static/, where older versions kept them.
+
+    Each folder is moved with a single rename, and only if it hasn't been moved already, so uploads keep whichever layout
+    they had and the hard links between them and the blob store stay intact."""
+
+    for legacy, destination in (("static/uploads", UPLOAD_DIR),
+                                ("static/blobs", BLOB_DIR),
+                                ("static/derivatives", DERIVATIVE_DIR)):
+        if os.path.isdir(legacy) and not os.path.exists(destination):
+            os.makedirs(os.path.dirname(destination),
+                        exist_ok=True)
+            os.rename(legacy, destination)
+
+            console.info(text=f"Moved {legacy} to {destination}.")
+
+def prepare():
+    """Moves anything still kept in static/ out of it (see relocate) and creates the folders uploads are stored in.
+
+    This runs before anything else touches uploads, both at boot and before a one-off migration."""
+
+    relocate()
+
+    os.makedirs(UPLOAD_DIR,
+                exist_ok=True)
+    os.makedirs(BLOB_DIR,
+                exist_ok=True)
+
+def migrate_layout(batch_size: Optional[int] = 1000,
+                   pause: Optional[float] = 0.1) -> int:
+    """Moves every upload still stored in the flat layout to where upload_path says it belongs, returning how many were moved.
+
+    Each upload is hard linked into place before its flat entry is removed, so it's readable at every moment. Nothing is
+    recorded between runs: anything already moved simply isn't in the flat directory any more, so an interrupted migration
+    resumes by running it again. After every batch_size uploads it sleeps for pause seconds to leave room for requests."""
+
+    if config.uploads.depth == 0:
+        return 0
+
+    moved = 0
+
+    for entry in os.scandir(UPLOAD_DIR):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+
+        destination = upload_path(key=entry.name)
+        os.makedirs(os.path.dirname(destination),
+                    exist_ok=True)
+
+        if not os.path.exists(destination):
+            os.link(entry.path, destination)
+
+        os.remove(entry.path)
+        moved += 1
+
+        if moved % batch_size == 0:
+            console.verbose(text=f"Moved {moved} uploads to the sharded layout...")
+            sleep(pause)
+
+    console.info(text=f"Moved {moved} uploads to the sharded layout.")
+
+    return moved
+
+def stat(key: str,
+         file: Optional[File] = None) -> Optional[Any]:
+    """Returns the size and modification time of the upload with the given key, or None if it doesn't exist.
+
+    Files whose size was recorded at upload are described from their row, with their creation time as their modification
+    time, so nothing on disk or in the storage backend is touched. Older files give an os.stat_result if they're on the
+    local disk, or a util.storage.Stat if they're kept in a remote storage backend."""
+
+    file = file or constants.cache.get_file(key=key)
+
+    if file is not None and file.size is not None:
+        return Stat(size=file.size,
+                    mtime=timegm(file.created_at.utctimetuple()))
+
+    path = locate(key=key)
+
+    if path is not None:
+        return os.stat(path)
+
+    if constants.storage.local or file is None or file.digest is None:
+        return None
+
+    return constants.storage.stat(name=file.digest)
+
+def fetch(key: str) -> Optional[str]:
+    """Returns a local path to the contents of the upload with the given key, or None if it doesn't exist.
+
+    With a remote storage backend, the upload is streamed into the object cache the first time it's needed (e.g: to
+    make a thumbnail or render a page), without holding it in memory, and read from there until it's evicted."""
+
+    path = locate(key=key)
+
+    if path is not None or constants.storage.local:
+        return path
+
+    name = f"{key}@object"
+    cached = constants.objects.get(name=name)
+
+    if cached is not None:
+        return cached
+
+    if stat(key=key) is None:
+        return None
+
+    digest = constants.cache.get_file(key=key).digest
+
+    return constants.objects.get_or_create(name=name,
+                                           build=lambda: constants.storage.open(name=digest))
+
+def describe(filename: str,
+             size: int,
+             path: Optional[str] = None) -> dict:
+    """Returns the metadata recorded for an upload: its size, its MIME type and, if it's an image, its width and height.
+
+    The dimensions are read from the image at path, if it's given."""
+
+    width, height = utils.image_dimensions(source=path) if path is not None and utils.filetype(filename=filename) in ("image", "gif") else (None, None)
+
+    return dict(size=size,
+                mimetype=guess_type(url=filename)[0] or "application/octet-stream",
+                width=width,
+                height=height)
+
+def backfill_metadata(batch_size: Optional[int] = 500,
+                      pause: Optional[float] = 0.1) -> int:
+    """Records the metadata of every file uploaded before it was recorded at upload, returning how many files were filled in.
+
+    Files are read in batches of batch_size in ID order and each batch is written back with a single UPDATE, after
+    which it sleeps for pause seconds to leave room for requests. Finished rows no longer match, so an interrupted
+    backfill resumes by running it again. Files whose contents are missing are skipped and left as they are, and so are
+    deleted files, which no longer count against their owners' quotas.
+
+    The sizes filled in are added to their owners' usage counters, see util.quotas."""
+
+    filled = 0
+    after = 0
+
+    while True:
+        with constants.postgres.cursor() as con:
+            con.execute("""SELECT id, key
+                           FROM files
+                           WHERE size IS NULL AND deleted IS NOT TRUE AND id > %(after)s
+
+                           ORDER BY id
+                           LIMIT %(limit)s;""",
+                        dict(after=after,
+                             limit=batch_size))
+
+            rows = con.fetchall()
+
+        if not rows:
+            break
+
+        described = []
+        keys = {}
+
+        for file_id, key in rows:
+            found = stat(key=key)
+
+            if found is None:
+                continue
+
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            # only images need their contents read, and then
+            # only their header, for the dimensions
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            metadata = describe(filename=key,
+                                size=found.st_size,
+                                path=fetch(key=key) if utils.filetype(filename=key) in ("image", "gif") else None)
+
+            described.append((file_id, metadata["size"], metadata["mimetype"], metadata["width"], metadata["height"]))
+            keys[file_id] = key
+
+        if described:
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            # files deleted since they were read are left out, they
+            # no longer count against their owners' quotas
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            with constants.postgres.cursor() as con:
+                updated = execute_values(con,
+                                         """UPDATE files
+                                            SET size = data.size, mimetype = data.mimetype, width = data.width, height = data.height
+                                            FROM (VALUES %s) AS data (id, size, mimetype, width, height)
+                                            WHERE files.id = data.id AND files.deleted IS NOT TRUE
+
+                                            RETURNING files.id, files.owner_id, files.size, files.mimetype, files.width, files.height;""",
+                                         described,
+                                         template="(%s, %s::BIGINT, %s, %s::INT, %s::INT)",
+                                         page_size=len(described),
+                                         fetch=True)
+
+            owners = {}
+
+            for file_id, owner_id, size, mimetype, width, height in updated:
+                owners[owner_id] = owners.get(owner_id, 0) + size
+
+                file = constants.cache.get_file(key=keys[file_id])
+
+                if file is not None:
+                    file.size, file.mimetype, file.width, file.height = size, mimetype, width, height
+
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            # files without a recorded size were counted as 0 bytes
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            for owner_id, size in owners.items():
+                quotas.adjust(owner_id=owner_id,
+                              size=size)
+
+            filled += len(updated)
+
+        after = rows[-1][0]
+
+        console.verbose(text=f"Recorded the metadata of {filled} files...")
+        sleep(pause)
+
+    console.info(text=f"Recorded the metadata of {filled} files.")
+
+    return filled
+
+def blob_path(digest: str) -> str:
+    """Returns where the content with the given SHA-256 digest is stored by the local storage backend."""
+
+    return f"{BLOB_DIR}/{digest[:2]}/{digest}"
+
+def stage(stream: BinaryIO,
+          optimise: bool) -> StagedUpload:
+    """Writes an upload to a temporary file in a single pass, hashing it on the way.
+
+    Images that need optimising are decoded and re-encoded in memory (in a worker process if the pool is enabled),
+    everything else is copied across in chunks as it's read. The temporary file sits next to the blob store, so it can be
+    atomically renamed into place once it's complete: a crash can never leave a half-written upload behind."""
+
+    stages = {}
+    started = perf_counter()
+
+    hasher = sha256()
+    size = 0
+
+    descriptor, temp_path = mkstemp(prefix=".upload-",
+                                    dir=BLOB_DIR)
+
+    try:
+        with os.fdopen(descriptor, "wb") as temp:
+            if optimise:
+                data = constants.workers.run(tasks.optimise_image, stream.read())
+                stages["optimise"] = perf_counter() - started
+
+                hasher.update(data)
+                temp.write(data)
+                size = len(data)
+
+            else:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    temp.write(chunk)
+                    size += len(chunk)
+
+                stages["write"] = perf_counter() - started
+
+            mark = perf_counter()
+            temp.flush()
+            os.fsync(temp.fileno())
+            stages["sync"] = perf_counter() - mark
+
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    os.chmod(temp_path, 0o644)
+
+    return StagedUpload(path=temp_path,
+                        digest=hasher.hexdigest(),
+                        size=size,
+                        stages=stages)
+
+def discard(staged: StagedUpload):
+    """Throws away a staged upload that won't be committed."""
+
+    if os.path.exists(staged.path):
+        os.remove(staged.path)
+
+def commit(staged: StagedUpload,
+           key: str) -> Dict[str, float]:
+    """Stores a staged upload under its key and returns how long each stage took.
+
+    Content is stored once per digest in the storage backend: if the same bytes have been uploaded before, the staged
+    copy is dropped and the existing blob is reused. With the local backend the key is then hard linked to the blob at
+    upload_path(key), so file URLs work exactly as before.
+
+    The blob's reference is taken before anything else, so a concurrent remove can't delete the blob between it being
+    found and the key being linked to it. If storing or linking fails, the reference is dropped again."""
+
+    stages = staged.stages
+    mark = perf_counter()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # xmax is 0 only for a freshly inserted row, i.e: nobody
+    # held a reference to this content before us
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    with constants.postgres.cursor() as con:
+        con.execute("""INSERT INTO blobs (digest, size, refs)
+                       VALUES (%(digest)s, %(size)s, 1)
+
+                       ON CONFLICT (digest) DO UPDATE
+                       SET refs = blobs.refs + 1
+
+                       RETURNING (xmax = 0);""",
+                    dict(digest=staged.digest,
+                         size=staged.size))
+
+        inserted = con.fetchone()[0]
+
+    stages["reference"] = perf_counter() - mark
+
+    try:
+        mark = perf_counter()
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # an existing reference may belong to an identical upload
+        # that hasn't finished storing the blob yet, in which case
+        # we store our copy too rather than link to nothing
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        if not inserted and constants.storage.stat(name=staged.digest) is not None:
+            discard(staged=staged)
+            stages["deduplicated"] = 0.0
+
+        else:
+            constants.storage.put_file(name=staged.digest,
+                                       path=staged.path)
+
+        stages["store"] = perf_counter() - mark
+
+        if constants.storage.local:
+            mark = perf_counter()
+
+            destination = upload_path(key=key)
+            os.makedirs(os.path.dirname(destination),
+                        exist_ok=True)
+            os.link(constants.storage.path(name=staged.digest), destination)
+            stages["link"] = perf_counter() - mark
+
+    except BaseException:
+        discard(staged=staged)
+        release(digest=staged.digest)
+        raise
+
+    stages["total"] = sum(seconds for stage, seconds in stages.items())
+
+    record(stages=stages)
+    console.verbose(text=f"Stored {key} in {round(stages['total'] * 1000, 2)}ms ({', '.join(f'{stage}: {round(seconds * 1000, 2)}ms' for stage, seconds in stages.items() if stage != 'total')}).")
+
+    return stages
+
+def dereference(digest: str,
+                con: Any) -> Optional[int]:
+    """Drops one reference to a blob in con's transaction, returning how many are left (None if it has no row).
+
+    The blob itself is left alone, even with no references left, until collect removes it."""
+
+    con.execute("""UPDATE blobs
+                   SET refs = refs - 1
+                   WHERE digest = %(digest)s
+
+                   RETURNING refs;""",
+                dict(digest=digest))
+
+    row = con.fetchone()
+
+    return row[0] if row is not None else None
+
+def collect(digest: str):
+    """Deletes a blob if nothing refers to it any more.
+
+    The blob's row stays locked until the blob is gone, so a commit taking a new reference at the same time waits for
+    the delete to finish and then stores the content afresh, instead of linking to a blob that's about to disappear.
+    If deleting the blob fails its row is kept, so collect_orphans finds it again."""
+
+    with constants.postgres.transaction() as con:
+        con.execute("""SELECT refs
+                       FROM blobs
+                       WHERE digest = %(digest)s
+
+                       FOR UPDATE;""",
+                    dict(digest=digest))
+
+        row = con.fetchone()
+
+        if row is None or row[0] > 0:
+            return
+
+        constants.storage.delete(name=digest)
+        compression.remove_sidecars(path=blob_path(digest=digest))
+
+        con.execute("""DELETE FROM blobs
+                       WHERE digest = %(digest)s;""",
+                    dict(digest=digest))
+
+def collect_orphans(limit: Optional[int] = 100) -> int:
+    """Deletes up to limit blobs that nothing refers to any more, e.g: because deleting them failed the first time,
+    returning how many were looked at."""
+
+    with constants.postgres.cursor() as con:
+        con.execute("""SELECT digest
+                       FROM blobs
+                       WHERE refs <= 0
+                       LIMIT %(limit)s;""",
+                    dict(limit=limit))
+
+        digests = [row[0] for row in con.fetchall()]
+
+    for digest in digests:
+        collect(digest=digest)
+
+    return len(digests)
+
+def release(digest: str):
+    """Drops one reference to a blob, deleting the blob once nothing refers to it."""
+
+    with constants.postgres.transaction() as con:
+        refs = dereference(digest=digest,
+                           con=con)
+
+    if refs is not None and refs <= 0:
+        collect(digest=digest)
+
+def remove(file: File):
+    """Deletes a file's key and its derivatives. Everything is safe to remove twice.
+
+    The file's reference to its blob isn't dropped here: that's done together with its row (see dereference), and the
+    blob is removed afterwards by collect."""
+
+    path = locate(key=file.key)
+
+    if path is not None:
+        os.remove(path)
+
+    constants.thumbnails.remove(key=file.key)
+    constants.variants.remove(key=file.key)
+    constants.pages.remove(key=file.key)
+
+    if constants.objects is not None:
+        constants.objects.remove(key=file.key)
+
+def precompress(digest: str):
+    """Writes the precompressed sidecars of a blob in the background, unless an earlier upload of the same content already did.
+
+    Sidecars are only kept for the local storage backend, where they sit next to the blob."""
+
+    if not constants.storage.local:
+        return
+
+    path = blob_path(digest=digest)
+
+    if compression.sidecars(path=path):
+        return
+
+    def make():
+        try:
+            constants.workers.run(tasks.precompress, path)
+
+        except Exception as error:
+            console.warn(text=f"Failed to precompress {digest}.\n\n{error}")
+
+    spawn(make)
@@ -7,26 +7,29 @@
 # ------------
 # Type imports
 # ------------
-from typing import Any, Callable, List, Iterable, Optional, Union
+from typing import Any, BinaryIO, Callable, List, Iterable, Optional, Tuple, Union
 from util.blueprints import User
 
 
-# -----------------
-# Builtin libraries
-# -----------------
-from random import choice
-from string import ascii_letters, digits
-
 # ------------------------
 # Third-party dependencies
 # ------------------------
 from flask import jsonify
-from PIL import Image
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image, ImageOps
+from psycopg2 import IntegrityError
 
 # -------------------------
 # Local extension libraries
 # -------------------------
+from util import constants
 from util.constants import cache, config, const
+from util.keys import hash_token, KeyAllocator
+
+
+allocators = {}
+sessions = URLSafeSerializer(secret_key=config.security.secret_key,
+                             salt="imago-session")
 
 
 def get_user(token_or_id: Union[str, int]) -> Union[User, None]:
@@ -34,54 +37,134 @@ def get_user(token_or_id: Union[str, int]) -> Union[User, None]:
     
     The token is used for backend user retrieval but also for authentication when uploading files."""
 
-    try:
-        token_or_id = int(token_or_id)
-    
-    except ValueError:
-        pass
+    if isinstance(token_or_id, int) or (isinstance(token_or_id, str) and token_or_id.isdigit()):
+        return cache.user_by_id(id=int(token_or_id))
 
     if isinstance(token_or_id, str):
-        key = "api_token"
+        return cache.user_by_token(token=token_or_id)
 
-    else:
-        key = "id"
-
-    if (key == "api_token" and token_or_id == const.superuser.token) or \
-       (key == "id" and token_or_id == const.superuser.id):
-        return const.superuser
+    return None
 
-    return first(iterable=cache.users,
-                 condition=lambda user: token_or_id in (user.token, user.id))
+def check_user(token: Union[str, None]) -> Union[User, None]:
+    """Runs checks to see if a user can be retrieved from an API token or a cookie.
 
-def check_user(token: Union[str, int, None]) -> Union[User, None]:
-    """Runs checks to see if a user can be retrieved from a cookie."""
+    This is called on every authenticated request, so it's a single token index lookup. User IDs are never accepted here.
+    If tokens are stored hashed, dashboard cookies hold a signed session instead of the token, which is checked second."""
 
     if not token:
         return None
 
-    return get_user(token_or_id=token)
+    user = cache.user_by_token(token=token)
+
+    if user is None and cache.hash_tokens:
+        return session_user(session=token)
+
+    return user
+
+def can_delete(user: User,
+               owner: Optional[User]) -> bool:
+    """Checks whether or not a user may delete (or restore) a file or URL belonging to owner.
+
+    Users may delete their own, admins may delete anyone's but other admins', and the superuser may delete anything.
+    Anything whose owner has been removed (owner is None) may be deleted by any admin."""
+
+    if owner is None:
+        return user.admin
+
+    # ========================================================
+    # - User isn't admin and isn't trying to delete their file
+    # - Both admin but user is not superuser
+    # ========================================================
+    if (not user.admin and user.id != owner.id) \
+       or (user.admin and owner.admin and user.id != owner.id and user.id != const.superuser.id):
+        return False
+
+    return True
+
+def store_token(token: str) -> str:
+    """Returns the form a newly generated API token should be stored in."""
+
+    return hash_token(token=token) if cache.hash_tokens else token
+
+def make_session(user: User) -> str:
+    """Returns a signed dashboard session for a user, used as the login cookie when tokens are stored hashed.
+
+    The session is tied to the user's stored token, so resetting the token logs every session out."""
+
+    return sessions.dumps([user.id, user.token])
+
+def session_user(session: str) -> Union[User, None]:
+    """Returns the user a signed dashboard session belongs to, or None if it's invalid or out of date."""
+
+    try:
+        id, token = sessions.loads(session)
+
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+    user = cache.user_by_id(id=id)
+
+    if user is None or user.token != token:
+        return None
+
+    return user
+
+def allocator(cache_obj: str) -> KeyAllocator:
+    """Returns the key allocator for files, urls or tokens, creating it the first time it's needed.
+
+    This is done lazily so that the registry has been populated and the starting key length can account for every existing key."""
+
+    if cache_obj not in allocators:
+        if cache_obj == "tokens":
+            allocators[cache_obj] = KeyAllocator(length=config.generator.token,
+                                                 taken=lambda token: cache.user_by_token(token=token) is not None,
+                                                 pool_size=config.generator.pool_size)
+
+        else:
+            allocators[cache_obj] = KeyAllocator(length=config.generator.get(cache_obj),
+                                                 taken=cache.has_file if cache_obj == "files" else cache.has_url,
+                                                 pool_size=config.generator.pool_size,
+                                                 grow_at=config.generator.grow_at,
+                                                 occupied=cache.count_files() if cache_obj == "files" else cache.count_urls())
+
+    return allocators[cache_obj]
 
-def generate_key(cache_obj="files"):
-    """This generates a unique, available key for an uploaded file."""
+def generate_key(cache_obj: Optional[str] = "files",
+                 suffix: Optional[str] = "") -> str:
+    """This generates a unique, available key for an uploaded file or shortened URL.
 
-    key = "".join(choice(ascii_letters + digits) for i in range(config.generator.get(cache_obj)))
+    The suffix (e.g: a file extension) is part of the collision check, so it should be passed here rather than appended afterwards."""
 
-    while key in [item.key for item in getattr(cache, cache_obj)]:
-        key = "".join(choice(ascii_letters + digits) for i in range(config.generator.get(cache_obj)))
-        
-    return key
+    return allocator(cache_obj=cache_obj).allocate(suffix=suffix)
 
-def generate_token():
+def generate_token() -> str:
     """This simply generates a unique, available token for a user.
     
     There's no need to worry about the superuser token here because it will always have Master at the start of it and spaces can't be generated here."""
 
-    token = "".join(choice(ascii_letters + digits) for i in range(config.generator.token))
+    return allocator(cache_obj="tokens").allocate()
 
-    while token in [user.token for user in cache.users]:
-        token = "".join(choice(ascii_letters + digits) for i in range(config.generator.token))
-        
-    return token
+def insert_with_key(table: str,
+                    suffix: Optional[str] = "",
+                    **values: dict) -> Tuple[str, int]:
+    """Generates a key for a new file or URL and inserts its row, returning the key and the row's ID.
+
+    Another worker process may hand out the same key at the same time, in which case the unique constraint on the key
+    column rejects our row and we simply try again with a fresh key."""
+
+    for _ in range(config.generator.retries):
+        key = generate_key(cache_obj=table,
+                           suffix=suffix)
+
+        try:
+            return key, constants.writer.insert(table=table,
+                                                key=key,
+                                                **values)
+
+        except IntegrityError:
+            allocator(cache_obj=table).collided()
+
+    raise RuntimeError(f"Couldn't find a free {table} key after {config.generator.retries} attempts.")
 
 def filetype(filename: str) -> Union[str, bool]:
     """This checks to see if the extension of the provided filename is legal according to the configuration file.
@@ -132,18 +215,114 @@ def bypass_optimise(header: str,
 
     return True
 
-def optimise_image(key: str):
-    """Takes in an file object from Flask and optimises it according to the configuration.
-    
-    Because the default .save function doesn't allow for optimisation kwargs, we need to save the file, 
-    open it with PIL and overwrite the file with the optimised data."""
+def optimise_image(source: BinaryIO,
+                   destination: BinaryIO):
+    """Decodes an image from source and writes an optimised copy of it to destination according to the configuration.
+
+    Both are file objects, so the upload can be re-encoded straight from the request stream without ever being written to disk as-is."""
+
+    image = Image.open(source)
+
+    image.save(fp=destination,
+               format=image.format,
+               optimize=config.file_optimisation.compress,
+               quality=config.file_optimisation.quality)
+
+def make_thumbnail(source: BinaryIO,
+                   destination: BinaryIO):
+    """Decodes an image from source and writes a JPEG thumbnail of it to destination according to the configuration.
+
+    Only the first frame of animated images is used, and transparent areas are filled in white since JPEG has no alpha channel."""
+
+    size = (config.thumbnails.size, config.thumbnails.size)
+    image = Image.open(source)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # lets the JPEG decoder skip straight to a reduced scale,
+    # which is much cheaper than decoding the full image
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    image.draft(mode="RGB",
+                size=size)
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert(mode="RGBA")
+
+        background = Image.new(mode="RGB",
+                               size=image.size,
+                               color="white")
+        background.paste(im=image,
+                         mask=image.getchannel(channel="A"))
+
+        image = background
+
+    else:
+        image = image.convert(mode="RGB")
 
-    path = f"static/uploads/{key}"
-    saved_file = Image.open(path)
+    image.thumbnail(size=size)
+    image.save(fp=destination,
+               format="JPEG",
+               optimize=True,
+               quality=config.thumbnails.quality)
+
+def resize_image(source: BinaryIO,
+                 destination: BinaryIO,
+                 width: int,
+                 height: int,
+                 fit: str,
+                 quality: int):
+    """Decodes an image from source and writes a resized copy of it to destination in the same format.
+
+    A width or height of 0 leaves that side unbounded. With fit set to contain, the image is scaled down to fit inside the
+    box; with cover, it fills the box and the overflow is cropped off. Images are never scaled up."""
+
+    image = Image.open(source)
+    image_format = image.format
+
+    image.draft(mode=image.mode,
+                size=(width or image.width, height or image.height))
+
+    if fit == "cover" and width and height:
+        scale = min(1, image.width / width, image.height / height)
+        image = ImageOps.fit(image=image,
+                             size=(round(width * scale), round(height * scale)))
+
+    else:
+        image.thumbnail(size=(width or image.width, height or image.height))
+
+    if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert(mode="RGB")
+
+    image.save(fp=destination,
+               format=image_format,
+               optimize=True,
+               quality=quality)
+
+def transcode_image(source: BinaryIO,
+                    destination: BinaryIO,
+                    image_format: str,
+                    quality: int):
+    """Decodes an image from source and writes it to destination in another format (e.g: WEBP or AVIF)."""
+
+    image = Image.open(source)
+
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert(mode="RGBA" if "transparency" in image.info else "RGB")
+
+    image.save(fp=destination,
+               format=image_format,
+               quality=quality)
+
+def image_dimensions(source: str) -> Tuple[Optional[int], Optional[int]]:
+    """Returns the width and height of an image, or (None, None) if it can't be decoded.
+
+    Only the image's header is read, the pixels are never decoded."""
+
+    try:
+        with Image.open(source) as image:
+            return image.size
 
-    saved_file.save(fp=path,
-                    optimize=config.file_optimisation.compress,
-                    quality=config.file_optimisation.quality)
+    except OSError:
+        return None, None
 
 def bytes_4_humans(count: int) -> str:
     """Returns a human friendly interpretation of bytes."""
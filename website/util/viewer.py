@@ -0,0 +1,132 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import List
+
+# -----------------
+# Builtin libraries
+# -----------------
+import os
+
+from collections import OrderedDict
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import constants, tasks
+from util.constants import config
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# line indexes of recently viewed files, as path:
+# (mtime, LineIndex), least recently used first
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+indexes = OrderedDict()
+
+
+class LineIndex:
+    """This is where each page of a text file starts, as byte offsets, along with its total size and line count.
+
+    Each page is lines_per_page lines long, so only one offset per page is kept and even a huge log file's index is tiny."""
+
+    def __init__(self,
+                 offsets: List[int],
+                 size: int,
+                 lines: int):
+        self.offsets = offsets
+        self.size = size
+        self.lines = lines
+
+    @property
+    def pages(self) -> int:
+        """Returns how many pages the file has."""
+
+        return len(self.offsets)
+
+
+class Page:
+    """This is one window of a text file, ready to be shown."""
+
+    def __init__(self,
+                 content: str,
+                 number: int,
+                 pages: int,
+                 first_line: int,
+                 truncated: bool):
+        self.content = content
+        self.number = number
+        self.pages = pages
+        self.first_line = first_line
+        self.truncated = truncated
+
+
+def line_index(path: str) -> LineIndex:
+    """Returns the line index of a file, building it in a worker process the first time the file is viewed.
+
+    Indexes are kept for the most recently viewed files and rebuilt if the file's mtime changes."""
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = indexes.get(path)
+
+    if cached is not None and cached[0] == mtime:
+        indexes.move_to_end(path)
+        return cached[1]
+
+    offsets, size, lines = constants.workers.run(tasks.index_lines, path, config.viewer.lines_per_page)
+    index = indexes[path] = (mtime, LineIndex(offsets=offsets,
+                                              size=size,
+                                              lines=lines))
+
+    indexes.move_to_end(path)
+
+    while len(indexes) > config.viewer.cached_indexes:
+        indexes.popitem(last=False)
+
+    return index[1]
+
+def read_page(path: str,
+              number: int) -> Page:
+    """Reads one page of a text file, counting from 1. Files that aren't big enough to paginate are one page long.
+
+    At most config.viewer.max_page_bytes are read, so a page made of a few enormous lines is cut short rather than read whole.
+    Page numbers past the end are clamped to the last page."""
+
+    if not paginated(path=path):
+        with open(file=path, mode="rb") as file:
+            data = file.read()
+
+        return Page(content=data.decode(encoding="utf-8",
+                                        errors="replace"),
+                    number=1,
+                    pages=1,
+                    first_line=1,
+                    truncated=False)
+
+    index = line_index(path=path)
+    number = min(max(number, 1), index.pages)
+
+    start = index.offsets[number - 1]
+    end = index.offsets[number] if number < index.pages else index.size
+    length = min(end - start, config.viewer.max_page_bytes)
+
+    with open(file=path, mode="rb") as file:
+        file.seek(start)
+        data = file.read(length)
+
+    return Page(content=data.decode(encoding="utf-8",
+                                    errors="replace"),
+                number=number,
+                pages=index.pages,
+                first_line=(number - 1) * config.viewer.lines_per_page + 1,
+                truncated=length < end - start)
+
+def paginated(path: str) -> bool:
+    """Checks whether or not a file is big enough to be shown a page at a time."""
+
+    return os.path.getsize(path) > config.viewer.paginate_above
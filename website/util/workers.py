@@ -0,0 +1,117 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, Callable, Optional
+
+# -----------------
+# Builtin libraries
+# -----------------
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import get_hub
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
+
+
+class WorkerPoolFull(Exception):
+    """Raised when a task couldn't be queued because too many tasks are already waiting."""
+
+
+class WorkerPool:
+    """This runs CPU-bound tasks (image optimisation, markdown and code rendering) in a pool of worker processes.
+
+    The greenlet that submits a task sleeps on the gevent hub until the task finishes, so other requests keep being
+    served in the meantime. At most max_pending tasks can be queued or running at once; anything past that waits up
+    to queue_timeout seconds for a slot and then raises WorkerPoolFull.
+
+    Tasks must be importable, picklable functions, see util.tasks. If the pool is disabled, tasks simply run inline."""
+
+    def __init__(self,
+                 enabled: Optional[bool] = False,
+                 processes: Optional[int] = 2,
+                 max_pending: Optional[int] = 32,
+                 queue_timeout: Optional[float] = 5,
+                 start_method: Optional[str] = "spawn"):
+        self.enabled = enabled
+        self.queue_timeout = queue_timeout
+
+        self._slots = BoundedSemaphore(value=max_pending)
+        self._executor = ProcessPoolExecutor(max_workers=processes,
+                                             mp_context=get_context(start_method)) if enabled else None
+
+        # =======
+        # Metrics
+        # =======
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self,
+            task: Callable,
+            *args: Any) -> Any:
+        """Runs a task in a worker process and returns its result, yielding to other greenlets while it runs."""
+
+        if not self.enabled:
+            return task(*args)
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise WorkerPoolFull(f"No worker became free within {self.queue_timeout}s.")
+
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # done callbacks run on the executor's own thread, so they
+        # wake the hub through an async watcher, which also keeps the
+        # loop alive while nothing else is happening
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        watcher = get_hub().loop.async_()
+        result = AsyncResult()
+
+        try:
+            future = self._executor.submit(task, *args)
+
+            watcher.start(self._settle, future, result)
+            future.add_done_callback(lambda _: watcher.send())
+
+            return result.get()
+
+        finally:
+            watcher.close()
+            self._slots.release()
+
+    def _settle(self,
+                future: Future,
+                result: AsyncResult):
+        """Copies a finished future's outcome onto the AsyncResult the submitting greenlet is waiting on."""
+
+        error = future.exception()
+
+        if error is not None:
+            result.set_exception(error)
+
+        else:
+            self.completed += 1
+            result.set(future.result())
+
+    @property
+    def stats(self) -> dict:
+        """Returns how many tasks have been run and rejected."""
+
+        return dict(enabled=self.enabled,
+                    completed=self.completed,
+                    rejected=self.rejected,
+                    free_slots=self._slots.counter)
+
+    def shutdown(self):
+        """Stops the worker processes."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
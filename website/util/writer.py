@@ -0,0 +1,171 @@
+# Copyright (C) JackTEK 2018-2020
+# -------------------------------
+
+# ========================
+# Import PATH dependencies
+# ========================
+# ------------
+# Type imports
+# ------------
+from typing import Any, List, Optional, Tuple
+
+# ------------------------
+# Third-party dependencies
+# ------------------------
+from gevent import spawn, spawn_later
+from gevent.event import AsyncResult
+from psycopg2.extras import execute_values
+
+# -------------------------
+# Local extension libraries
+# -------------------------
+from util import console
+
+
+COLUMNS = {
+    "files": ("owner_id", "key", "digest", "size", "mimetype", "width", "height", "created_at"),
+    "urls": ("owner_id", "key", "url", "created_at")
+}
+
+
+class BatchWriter:
+    """This collects file and URL inserts from concurrent requests and writes them as multi-row INSERTs.
+
+    A batch is flushed as soon as it holds max_rows rows or max_delay seconds after its first row arrived, whichever comes first.
+    Each request still waits for its own row to be written and gets its row ID back, so nothing is acknowledged before it's stored.
+
+    If batching is disabled, every insert is written straight away as a batch of one."""
+
+    def __init__(self,
+                 database: Any,
+                 enabled: Optional[bool] = False,
+                 max_rows: Optional[int] = 100,
+                 max_delay: Optional[float] = 0.005):
+        self.database = database
+
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+
+        self._pending = {table: [] for table in COLUMNS}
+        self._timers = {}
+
+        # =======
+        # Metrics
+        # =======
+        self.flushes = 0
+        self.rows = 0
+
+    def insert(self,
+               table: str,
+               **values: dict) -> int:
+        """Queues a row for the given table and waits until it has been written, returning its ID."""
+
+        result = AsyncResult()
+
+        if not self.enabled:
+            self._write(table=table,
+                        batch=[(values, result)])
+
+            return result.get()
+
+        pending = self._pending[table]
+        pending.append((values, result))
+
+        if len(pending) >= self.max_rows:
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            # the batch is taken now, rather than when the flush
+            # greenlet starts, so it never grows past max_rows
+            # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+            self._cancel_timer(table=table)
+            self._pending[table] = []
+
+            spawn(self._write, table, pending)
+
+        elif table not in self._timers:
+            self._timers[table] = spawn_later(self.max_delay, self.flush, table)
+
+        return result.get()
+
+    def _cancel_timer(self,
+                      table: str):
+        """Stops the delayed flush of a table, if one is scheduled."""
+
+        timer = self._timers.pop(table, None)
+
+        if timer is not None:
+            timer.kill(block=False)
+
+    def flush(self,
+              table: str):
+        """Writes every row currently queued for a table."""
+
+        self._timers.pop(table, None)
+
+        batch, self._pending[table] = self._pending[table], []
+
+        if batch:
+            self._write(table=table,
+                        batch=batch)
+
+    def _write(self,
+               table: str,
+               batch: List[Tuple[dict, AsyncResult]]):
+        """Writes a batch of rows with one INSERT and hands each waiting request its ID.
+
+        If the batch fails (e.g: one of the keys was taken by another process), each row is retried on its own so that
+        only the offending requests see the error."""
+
+        try:
+            ids = self._insert(table=table,
+                               rows=[values for values, _ in batch])
+
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+
+            console.warn(text=f"Batched insert of {len(batch)} {table} failed, retrying rows one by one.\n\n{error}")
+
+            for item in batch:
+                self._write(table=table,
+                            batch=[item])
+
+            return
+
+        self.flushes += 1
+        self.rows += len(batch)
+
+        for values, result in batch:
+            result.set(ids[values["key"]])
+
+    def _insert(self,
+                table: str,
+                rows: List[dict]) -> dict:
+        """Inserts rows into a table and returns a mapping of each key to its new ID.
+
+        Keys are unique, so they're used to match the returned IDs back up with their rows."""
+
+        columns = COLUMNS[table]
+        query = f"""INSERT INTO {table} ({", ".join(columns)})
+                    VALUES %s
+
+                    RETURNING key, id;"""
+
+        with self.database.cursor() as con:
+            returned = execute_values(con,
+                                      query,
+                                      [tuple(row[column] for column in columns) for row in rows],
+                                      page_size=len(rows),
+                                      fetch=True)
+
+        return dict(returned)
+
+    @property
+    def stats(self) -> dict:
+        """Returns how many batches and rows have been written."""
+
+        return dict(enabled=self.enabled,
+                    flushes=self.flushes,
+                    rows=self.rows,
+                    average_batch=round(self.rows / self.flushes, 2) if self.flushes else 0.0)